@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""Benchmark the ChatMix daemon without a headset.
+
+Runs `chatmix.py daemon` against synthetic headsets (bench/fakes/usb) that emit dial reports at a
+configurable rate, with recording stand-ins for pactl, pw-cli and pw-link on PATH and a fake native
+protocol server behind PULSE_SERVER.  For each volume backend it reports dial-to-volume latency,
+processes spawned, CPU time and startup time.
+
+    python3 bench/bench_chatmix.py
+    python3 bench/bench_chatmix.py --backend native --rate 500 --reports 5000 --pattern random
+    python3 bench/bench_chatmix.py --save baseline.json
+    python3 bench/bench_chatmix.py --compare baseline.json --fail-on-regression
+"""
+import argparse
+import bisect
+import json
+import math
+import os
+import re
+import resource
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+FAKES_DIR = BENCH_DIR / 'fakes'
+CHATMIX = BENCH_DIR.parent / 'chatmix.py'
+sys.path.insert(0, str(FAKES_DIR))
+
+from pulse_server import FakePulseServer  # noqa: E402
+
+# metrics where a larger value is worse, compared against a saved baseline
+REGRESSION_METRICS = ('latency_p50_ms', 'latency_p99_ms', 'spawns_per_second', 'cpu_seconds', 'startup_seconds', 'init_seconds')
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+
+def parse_command_log(path):
+    """Return (timestamp, argv string) for each stub invocation.  Commands fed to a stub on stdin are not processes
+    and are left out.
+    """
+    calls = []
+    if path.exists():
+        for line in path.read_text().splitlines():
+            stamp, _, command = line.partition(' ')
+            if not command.startswith('stdin '):
+                calls.append((float(stamp), command))
+    return calls
+
+
+def parse_emitted(path):
+    """Return {location: {game value: sorted emission times}} and the emission time range"""
+    emitted = {}
+    first, last = None, None
+    if path.exists():
+        for line in path.read_text().splitlines():
+            stamp, location, game, _ = line.split()
+            stamp = float(stamp)
+            emitted.setdefault(location, {}).setdefault(int(game), []).append(stamp)
+            first = stamp if first is None else min(first, stamp)
+            last = stamp if last is None else max(last, stamp)
+    for values in emitted.values():
+        for times in values.values():
+            times.sort()
+    return emitted, first, last
+
+
+def applied_game_volumes(backend, server, calls):
+    """Return (timestamp, location, game volume) for each Game sink volume change the daemon made"""
+    applied = []
+    if backend == 'pactl':
+        for stamp, command in calls:
+            match = re.match(r'pactl set-sink-volume (Arctis_Game\S*) (\d+)%', command)
+            if match:
+                applied.append((stamp, match.group(1), int(match.group(2))))
+    else:
+        applied = [entry for entry in server.volumes if entry[1].startswith('Arctis_Game')]
+    return [(stamp, sink.rpartition('_')[2], volume) for stamp, sink, volume in applied]
+
+
+def run_once(options, backend):
+    workdir = Path(tempfile.mkdtemp(prefix='chatmix-bench-'))
+    command_log = workdir / 'commands.log'
+    reports_log = workdir / 'reports.log'
+    server = FakePulseServer(str(workdir / 'pulse-native'))
+    scenario = {
+        'headsets': options.headsets,
+        'rate': options.rate,
+        'reports': options.reports,
+        'pattern': options.pattern,
+        'seed': options.seed,
+        'start_delay': options.start_delay,
+    }
+    env = dict(os.environ)
+    env.update({
+        'PATH': f'{FAKES_DIR / "bin"}{os.pathsep}{env.get("PATH", "")}',
+        'PYTHONPATH': str(FAKES_DIR),
+        'PYTHONUNBUFFERED': '1',
+        'CHATMIX_BENCH_SCENARIO': json.dumps(scenario),
+        'CHATMIX_BENCH_LOG': str(command_log),
+        'CHATMIX_BENCH_REPORTS': str(reports_log),
+        'CHATMIX_BENCH_HEADSETS': str(options.headsets),
+        'PULSE_SERVER': f'unix:{workdir / "pulse-native"}',
+        'XDG_RUNTIME_DIR': str(workdir),
+        'HOME': str(workdir),
+    })
+    # the daemon refuses to run as root, pretend to be a desktop user in root CI containers
+    if os.getuid() == 0:
+        env['SUDO_UID'] = '1000'
+        env['SUDO_USER'] = 'bench'
+
+    lines = []
+    disconnected = threading.Event()
+
+    def read_output(stream):
+        disconnects = 0
+        for line in stream:
+            lines.append((time.time(), line.rstrip('\n')))
+            if 'likely disconnect' in line:
+                disconnects += 1
+                if disconnects >= options.headsets:
+                    disconnected.set()
+        disconnected.set()
+
+    usage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    spawned = time.time()
+    proc = subprocess.Popen(
+        [options.python, options.chatmix, 'daemon', '--hotplug', 'poll', '--backend', backend, '--max-rate', str(options.max_rate)] + options.daemon_args,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, env=env)
+    reader = threading.Thread(target=read_output, args=(proc.stdout,), daemon=True)
+    reader.start()
+    disconnected.wait(options.start_delay + options.reports / options.rate + options.timeout)
+    proc.send_signal(signal.SIGTERM)
+    try:
+        proc.wait(options.timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+    reader.join(5)
+    usage_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    server.close()
+
+    calls = parse_command_log(command_log)
+    emitted, first_report, last_report = parse_emitted(reports_log)
+    enabled = [stamp for stamp, line in lines if 'ChatMix Enabled!' in line]
+    initializing = [stamp for stamp, line in lines if 'Initializing a7chatmix' in line]
+    ready = enabled[-1] if enabled else None
+
+    latencies = []
+    for stamp, location, volume in applied_game_volumes(backend, server, calls):
+        times = emitted.get(location, {}).get(volume, [])
+        index = bisect.bisect_right(times, stamp)
+        if index:
+            latencies.append(stamp - times[index - 1])
+
+    steady_calls = [stamp for stamp, _ in calls if ready is not None and stamp > ready]
+    span = (last_report - first_report) if first_report is not None and last_report > first_report else None
+    result = {
+        'backend': backend,
+        'exit_code': proc.returncode,
+        'reports_emitted': sum(len(times) for values in emitted.values() for times in values.values()),
+        'volumes_applied': len(latencies),
+        'latency_p50_ms': None if not latencies else percentile(latencies, 0.5) * 1000,
+        'latency_p99_ms': None if not latencies else percentile(latencies, 0.99) * 1000,
+        'startup_spawns': sum(1 for stamp, _ in calls if ready is None or stamp <= ready),
+        'spawns_per_second': None if span is None else len(steady_calls) / span,
+        'cpu_seconds': (usage_after.ru_utime - usage_before.ru_utime) + (usage_after.ru_stime - usage_before.ru_stime),
+        'startup_seconds': None if ready is None else ready - spawned,
+        'init_seconds': None if not (initializing and enabled) else enabled[0] - initializing[0],
+    }
+    if options.keep:
+        result['workdir'] = str(workdir)
+        (workdir / 'daemon.log').write_text('\n'.join(f'{stamp:.6f} {line}' for stamp, line in lines) + '\n')
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+def format_value(value):
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return f'{value:.3f}'
+    return str(value)
+
+
+def print_results(results, baseline=None):
+    keys = [key for key in results[0] if key not in ('backend', 'workdir')]
+    width = max(len(key) for key in keys)
+    print(f'{"":{width}}  ' + '  '.join(f'{result["backend"]:>14}' for result in results))
+    for key in keys:
+        row = []
+        for result in results:
+            cell = format_value(result[key])
+            old = (baseline or {}).get(result['backend'], {}).get(key)
+            if isinstance(old, (int, float)) and isinstance(result[key], (int, float)) and old:
+                cell += f' ({(result[key] - old) / old * 100:+.0f}%)'
+            row.append(f'{cell:>14}')
+        print(f'{key:{width}}  ' + '  '.join(row))
+
+
+def regressions(results, baseline, tolerance):
+    found = []
+    for result in results:
+        old = baseline.get(result['backend'], {})
+        for key in REGRESSION_METRICS:
+            if isinstance(old.get(key), (int, float)) and isinstance(result.get(key), (int, float)) and old[key] > 0:
+                if result[key] > old[key] * (1 + tolerance):
+                    found.append(f'{result["backend"]} {key}: {old[key]:.3f} -> {result[key]:.3f}')
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the ChatMix daemon with synthetic headsets')
+    parser.add_argument('--backend', nargs='+', default=['native', 'pactl'], help='Volume backends to benchmark (default: native pactl)')
+    parser.add_argument('--headsets', type=int, default=1, help='Number of synthetic headsets (default: 1)')
+    parser.add_argument('--rate', type=float, default=200, help='Dial reports per second per headset (default: 200)')
+    parser.add_argument('--reports', type=int, default=1000, help='Reports emitted per headset before it is unplugged (default: 1000)')
+    parser.add_argument('--pattern', choices=('sweep', 'random'), default='sweep', help='Dial movement (default: sweep)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the random pattern')
+    parser.add_argument('--max-rate', type=float, default=50, help='--max-rate passed to the daemon (default: 50)')
+    parser.add_argument('--start-delay', type=float, default=0.5, help='Seconds between the first read and the first report (default: 0.5)')
+    parser.add_argument('--timeout', type=float, default=15, help='Extra seconds to wait for the daemon before giving up (default: 15)')
+    parser.add_argument('--python', default=sys.executable, help='Interpreter used to run chatmix.py')
+    parser.add_argument('--chatmix', default=str(CHATMIX), help='chatmix.py to benchmark, e.g. from a baseline checkout (default: this tree)')
+    parser.add_argument('--daemon-arg', dest='daemon_args', action='append', default=[], help='Extra argument passed to the daemon, may be repeated')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    parser.add_argument('--save', help='Write results to a baseline file')
+    parser.add_argument('--compare', help='Compare results against a baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Relative increase tolerated before --fail-on-regression fails (default: 0.25)')
+    parser.add_argument('--fail-on-regression', action='store_true', help='Exit with status 1 if a metric regressed beyond the tolerance')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary directory with logs of each run')
+    options = parser.parse_args()
+
+    results = [run_once(options, backend) for backend in options.backend]
+    baseline = None
+    if options.compare:
+        baseline = {result['backend']: result for result in json.loads(Path(options.compare).read_text())}
+
+    if options.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results, baseline)
+    if options.save:
+        Path(options.save).write_text(json.dumps(results, indent=2) + '\n')
+
+    if any(result['exit_code'] != 0 or not result['volumes_applied'] for result in results):
+        print('Daemon failed or applied no volumes, rerun with --keep to inspect its log.', file=sys.stderr)
+        sys.exit(1)
+    if baseline and options.fail_on_regression:
+        found = regressions(results, baseline, options.tolerance)
+        if found:
+            print('Regressions beyond tolerance:\n  ' + '\n  '.join(found), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""Compare the audio graph topologies of the daemon on a private, headless PipeWire instance.
+
+Starts `pipewire` in a temporary runtime directory (so the desktop session is untouched), creates a null sink
+standing in for the headset, builds either the `sinks` topology (Game and Chat null sinks whose monitors are
+linked to the headset) or the `mixer` topology (one filter-chain mixer node, the config chatmix.py generates),
+plays a tone into the Game and Chat inputs and samples `pw-top` while it plays.
+
+For each topology it reports the nodes audio passes through, the graph quantum, the processing time the
+topology's nodes add to each cycle and the driver's DSP load.  Needs pipewire, pw-cli, pw-link, pw-cat and
+pw-top, and chatmix.py's own dependencies (pyusb); no session manager or audio device is required.
+
+    python3 bench/bench_graph.py
+    python3 bench/bench_graph.py --graph mixer --quantum 256 --seconds 20 --json
+"""
+import argparse
+import json
+import math
+import os
+import shutil
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR.parent))
+from chatmix import mixer_config  # noqa: E402
+HEADSET = 'bench_headset'
+GAME, CHAT, MIXER = 'Arctis_Game_bench', 'Arctis_Chat_bench', 'Arctis_ChatMix_bench'
+RATE = 48000
+
+
+def write_tone(path, seconds, channels):
+    with wave.open(str(path), 'wb') as tone:
+        tone.setnchannels(channels)
+        tone.setsampwidth(2)
+        tone.setframerate(RATE)
+        frame = bytearray()
+        for index in range(RATE):
+            sample = int(8000 * math.sin(2 * math.pi * 440 * index / RATE))
+            frame += struct.pack('<h', sample) * channels
+        for _ in range(math.ceil(seconds)):
+            tone.writeframes(frame)
+
+
+def run(command, env, check=True):
+    return subprocess.run(command, env=env, check=check, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+
+
+def link(links, env, attempts=100):
+    for _ in range(attempts):
+        failed = [pair for pair in links if run(['pw-link', *pair], env, check=False).returncode != 0]
+        if not failed:
+            return
+        links = failed
+        time.sleep(0.05)
+    raise RuntimeError(f'Could not link {failed}')
+
+
+def null_sink(name, channels='[FL FR]'):
+    return (f'create-node adapter {{ factory.name=support.null-audio-sink node.name={name} media.class=Audio/Sink '
+            f'object.linger=true audio.position={channels} monitor.channel-volumes=true }}')
+
+
+def player(name, path, env):
+    """Play path without connecting it anywhere, the caller links it"""
+    command = ['pw-cat', '--playback', '--target', '0', '-P', f'{{ node.name = {name} node.autoconnect = false }}', str(path)]
+    return subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def parse_pw_top(output):
+    """Return {node name: [(quantum, rate, wait us, busy us, busy/quantum, errors)]} from `pw-top -b` output"""
+    nodes = {}
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) < 10 or fields[0] not in ('R', 'S', 'I', 'C') or not fields[1].isdigit():
+            continue
+        nodes.setdefault(fields[-1], []).append((number(fields[2]), number(fields[3]), micros(fields[4]), micros(fields[5]),
+                                                 number(fields[7]), number(fields[8])))
+    return nodes
+
+
+def number(value):
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def micros(value):
+    """pw-top times carry their unit, e.g. 10.2us or 1.3ms"""
+    for unit, scale in (('us', 1), ('ms', 1000), ('s', 1000000)):
+        if value.endswith(unit):
+            amount = number(value[:-len(unit)])
+            return None if amount is None else amount * scale
+    return number(value)
+
+
+def run_once(options, graph):
+    workdir = Path(tempfile.mkdtemp(prefix='chatmix-graph-'))
+    env = dict(os.environ, XDG_RUNTIME_DIR=str(workdir), PIPEWIRE_RUNTIME_DIR=str(workdir),
+               PIPEWIRE_REMOTE='pipewire-0', PIPEWIRE_QUANTUM=f'{options.quantum}/{RATE}')
+    env.pop('PULSE_SERVER', None)
+    processes = []
+    try:
+        processes.append(subprocess.Popen(['pipewire'], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        for _ in range(100):
+            if (workdir / 'pipewire-0').exists():
+                break
+            time.sleep(0.05)
+        run(['pw-metadata', '-n', 'settings', '0', 'clock.force-quantum', str(options.quantum)], env, check=False)
+
+        started = time.monotonic()
+        if graph == 'mixer':
+            config = workdir / 'mixer.conf'
+            config.write_text(mixer_config(MIXER, 'Bench ChatMix'))
+            commands = [null_sink(HEADSET)]
+            processes.append(subprocess.Popen(['pipewire', '-c', str(config)], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+            links = [(f'{MIXER}_output:output_FL', f'{HEADSET}:playback_FL'), (f'{MIXER}_output:output_FR', f'{HEADSET}:playback_FR')]
+            path_nodes = [MIXER, f'{MIXER}_output']
+        else:
+            commands = [null_sink(HEADSET), null_sink(GAME), null_sink(CHAT)]
+            links = [(f'{sink}:monitor_{channel}', f'{HEADSET}:playback_{channel}') for sink in (GAME, CHAT) for channel in ('FL', 'FR')]
+            path_nodes = [GAME, CHAT]
+        subprocess.run(['pw-cli'], input=''.join(f'{command}\n' for command in commands), env=env, text=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        link(links, env)
+        setup_seconds = time.monotonic() - started
+
+        # a Game and a Chat stream, as in a game with voice chat running
+        tone = workdir / 'tone.wav'
+        write_tone(tone, options.seconds + 5, 2)
+        players = [('bench_game', GAME if graph == 'sinks' else MIXER, ('FL', 'FR')),
+                   ('bench_chat', CHAT if graph == 'sinks' else MIXER, ('FL', 'FR') if graph == 'sinks' else ('AUX0', 'AUX1'))]
+        for name, target, channels in players:
+            processes.append(player(name, tone, env))
+        link([(f'{name}:output_{side}', f'{target}:playback_{channel}')
+              for name, target, channels in players for side, channel in zip(('FL', 'FR'), channels)], env)
+
+        time.sleep(1)
+        top = run(['pw-top', '-b', '-n', str(max(2, int(options.seconds)))], env, check=False).stdout
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if not options.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    nodes = parse_pw_top(top)
+    # the headset stand-in isn't a driver, the graph runs on PipeWire's dummy driver
+    driver_samples = nodes.get('Dummy-Driver', [])
+    quantum = statistics.median(sample[0] for sample in driver_samples if sample[0]) if driver_samples else None
+    busy = [sum(sample[3] or 0 for sample in samples) / len(samples) for name, samples in nodes.items() if name in path_nodes and samples]
+    return {
+        'graph': graph,
+        'nodes_in_path': len(path_nodes),
+        'links': len(links),
+        'setup_seconds': setup_seconds,
+        'quantum_frames': quantum,
+        'quantum_latency_ms': None if not quantum else quantum / RATE * 1000,
+        'graph_busy_us': sum(busy) if busy else None,
+        'dsp_load_pct': statistics.mean(sample[4] * 100 for sample in driver_samples if sample[4] is not None) if driver_samples else None,
+        'xruns': max((sample[5] or 0 for samples in nodes.values() for sample in samples), default=None),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare ChatMix graph topologies on a headless PipeWire')
+    parser.add_argument('--graph', nargs='+', choices=('sinks', 'mixer'), default=['sinks', 'mixer'], help='Topologies to benchmark (default: sinks mixer)')
+    parser.add_argument('--quantum', type=int, default=1024, help='Graph quantum in frames at 48 kHz (default: 1024)')
+    parser.add_argument('--seconds', type=float, default=10, help='Seconds of pw-top samples per topology (default: 10)')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary runtime directories')
+    options = parser.parse_args()
+
+    missing = [tool for tool in ('pipewire', 'pw-cli', 'pw-link', 'pw-cat', 'pw-top', 'pw-metadata') if not shutil.which(tool)]
+    if missing:
+        print(f'Missing PipeWire tools: {", ".join(missing)}', file=sys.stderr)
+        sys.exit(1)
+
+    results = [run_once(options, graph) for graph in options.graph]
+    if options.json:
+        print(json.dumps(results, indent=2))
+        return
+    keys = [key for key in results[0] if key != 'graph']
+    width = max(len(key) for key in keys)
+    print(f'{"":{width}}  ' + '  '.join(f'{result["graph"]:>10}' for result in results))
+    for key in keys:
+        cells = []
+        for result in results:
+            value = result[key]
+            cells.append(f'{"-" if value is None else (f"{value:.3f}" if isinstance(value, float) else value):>10}')
+        print(f'{key:{width}}  ' + '  '.join(cells))
+
+
+if __name__ == '__main__':
+    main()
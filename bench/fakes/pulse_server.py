@@ -0,0 +1,86 @@
+"""Minimal PulseAudio native protocol server for the benchmark harness.
+
+It authenticates any client, acknowledges every command and records each SET_SINK_VOLUME it receives.
+"""
+import os
+import socket
+import struct
+import threading
+import time
+
+PA_COMMAND_REPLY = 2
+PA_COMMAND_AUTH = 8
+PA_COMMAND_SET_CLIENT_NAME = 9
+PA_COMMAND_SET_SINK_VOLUME = 36
+PA_VOLUME_NORM = 0x10000
+HEADER = struct.Struct('>IIIII')
+
+
+def _recv_exact(conn, n):
+    data = bytearray()
+    while len(data) < n:
+        chunk = conn.recv(n - len(data))
+        if not chunk:
+            raise EOFError
+        data += chunk
+    return bytes(data)
+
+
+def _reply(tag, payload=b''):
+    body = b'L' + struct.pack('>I', PA_COMMAND_REPLY) + b'L' + struct.pack('>I', tag) + payload
+    return HEADER.pack(len(body), 0xffffffff, 0, 0, 0) + body
+
+
+class FakePulseServer:
+    def __init__(self, path):
+        self.path = path
+        self.volumes = []
+        self.connections = 0
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen()
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            self.connections += 1
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def handle(self, command, tag, payload):
+        """Return the reply payload for a command; override to emulate more of the protocol"""
+        if command == PA_COMMAND_AUTH:
+            return b'L' + struct.pack('>I', 32)
+        if command == PA_COMMAND_SET_CLIENT_NAME:
+            return b'L' + struct.pack('>I', self.connections)
+        if command == PA_COMMAND_SET_SINK_VOLUME:
+            # payload: index (L), name (t ... \0), cvolume (v, channels, u32 each)
+            name_end = payload.index(b'\0', 6)
+            name = payload[6:name_end].decode()
+            volume = struct.unpack_from('>I', payload, name_end + 3)[0]
+            with self.lock:
+                self.volumes.append((time.time(), name, round(volume * 100 / PA_VOLUME_NORM)))
+        return b''
+
+    def _serve(self, conn):
+        try:
+            while True:
+                length, _, _, _, _ = HEADER.unpack(_recv_exact(conn, HEADER.size))
+                packet = _recv_exact(conn, length)
+                command, tag = struct.unpack_from('>I', packet, 1)[0], struct.unpack_from('>I', packet, 6)[0]
+                conn.sendall(_reply(tag, self.handle(command, tag, packet[10:])))
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    def close(self):
+        self.sock.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
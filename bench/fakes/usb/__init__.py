@@ -0,0 +1,6 @@
+"""Stand-in for PyUSB used by the benchmark harness.
+
+Only the parts of the API that chatmix.py touches are provided.  The headsets it reports are synthetic
+devices described by the JSON scenario in the CHATMIX_BENCH_SCENARIO environment variable.
+"""
+from . import core, util
@@ -0,0 +1,144 @@
+import array
+import atexit
+import json
+import os
+import random
+import threading
+import time
+
+
+class USBError(IOError):
+    pass
+
+
+class USBTimeoutError(USBError):
+    pass
+
+
+class FakeEndpoint:
+    def __init__(self, address):
+        self.bEndpointAddress = address
+
+
+class FakeInterface:
+    def __init__(self, number):
+        self.bInterfaceNumber = number
+        self.bInterfaceClass = 3
+        self.endpoint = FakeEndpoint(0x80 | (number + 1))
+
+    def endpoints(self):
+        return [self.endpoint]
+
+
+class FakeConfiguration:
+    def __init__(self, interfaces):
+        self._interfaces = interfaces
+
+    def interfaces(self):
+        return self._interfaces
+
+
+class FakeDevice:
+    """A headset dongle emitting scripted or randomized ChatMix dial reports at a fixed rate"""
+
+    def __init__(self, index, scenario):
+        self.idVendor = 0x1038
+        self.idProduct = int(scenario.get('product', '220e'), 16)
+        self.bcdDevice = 0x0100
+        self.bcdUSB = 0x0200
+        self.bDeviceClass = 0
+        self.bMaxPacketSize0 = 64
+        self.bNumConfigurations = 1
+        self.iManufacturer = 1
+        self.iProduct = 2
+        self.iSerialNumber = 3
+        self.strings = {1: 'SteelSeries', 2: scenario.get('name', 'Arctis 7+'), 3: f'BENCH{index:04d}'}
+        self.bus = 1
+        self.address = index + 2
+        self.port_numbers = (index + 1,)
+        self.configuration = FakeConfiguration([FakeInterface(i) for i in range(10)])
+        self.rate = scenario.get('rate', 100)
+        self.count = scenario.get('reports', 1000)
+        self.start_delay = scenario.get('start_delay', 0.5)
+        self.pattern = scenario.get('pattern', 'sweep')
+        self.script = scenario.get('script', [])
+        self.random = random.Random(scenario.get('seed', 0) + index)
+        self.emitted = []
+        self.sent = 0
+        self.started = None
+        self.lock = threading.Lock()
+
+    def __getitem__(self, index):
+        return self.configuration
+
+    def is_kernel_driver_active(self, interface):
+        return False
+
+    def detach_kernel_driver(self, interface):
+        pass
+
+    @property
+    def unplugged(self):
+        return self.sent >= self.count
+
+    def _report(self, n):
+        if self.pattern == 'script' and self.script:
+            game, chat = self.script[n % len(self.script)]
+        elif self.pattern == 'random':
+            game, chat = self.random.randint(0, 100), self.random.randint(0, 100)
+        else:
+            # sweep the dial from Game to Chat and back, one step per report
+            position = n % 200
+            position = position if position <= 100 else 200 - position
+            game, chat = min(100, 200 - 2 * position), min(100, 2 * position)
+        return game, chat
+
+    def read(self, address, size, timeout=None):
+        with self.lock:
+            if self.started is None:
+                self.started = time.monotonic() + self.start_delay
+            if self.unplugged:
+                raise USBError('No such device (it may have been disconnected)')
+            n = self.sent
+            due = self.started + n / self.rate
+            wait = due - time.monotonic()
+            timeout = 1000 if timeout is None else timeout
+            if wait > timeout / 1000:
+                time.sleep(timeout / 1000)
+                raise USBTimeoutError('Operation timed out')
+            if wait > 0:
+                time.sleep(wait)
+            game, chat = self._report(n)
+            self.sent += 1
+            self.emitted.append((time.time(), game, chat))
+            # PyUSB returns an array of bytes
+            report = array.array('B', bytes(size))
+            report[0:3] = array.array('B', [0x45, game, chat])
+            return report
+
+
+_scenario = json.loads(os.environ.get('CHATMIX_BENCH_SCENARIO', '{}'))
+_devices = [FakeDevice(i, _scenario) for i in range(_scenario.get('headsets', 1))]
+
+
+def _dump_emitted():
+    path = os.environ.get('CHATMIX_BENCH_REPORTS')
+    if not path:
+        return
+    with open(path, 'a') as f:
+        for device in _devices:
+            for stamp, game, chat in device.emitted:
+                f.write(f'{stamp:.6f} {device.bus}-{device.port_numbers[0]} {game} {chat}\n')
+
+
+atexit.register(_dump_emitted)
+
+
+def find(find_all=False, idVendor=None, idProduct=None, custom_match=None, **kwargs):
+    devices = [d for d in _devices if not d.unplugged
+               and (idVendor is None or d.idVendor == idVendor)
+               and (idProduct is None or d.idProduct == idProduct)
+               and (custom_match is None or custom_match(d))]
+    if find_all:
+        return iter(devices)
+    return devices[0] if devices else None
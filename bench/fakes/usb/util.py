@@ -0,0 +1,2 @@
+def get_string(device, index):
+    return device.strings.get(index, '')
@@ -20,259 +20,2339 @@
     along with this program.  If not, see <https://www.gnu.org/licenses/>.
     """
 import argparse
+import atexit
+import bisect
+import collections
+import ctypes
+import errno
+import fcntl
+import functools
 import getpass
+import json
 import logging
+import logging.handlers
+import mmap
 import os
 import re
 import signal
+import socket
+import struct
 import subprocess
 import sys
 import platform
+import pwd
+import time
+import queue
+import threading
 from pathlib import Path
-from time import sleep
+from time import monotonic, sleep
 
 import usb.core
+import usb.util
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'{value} is not a positive number')
+    return number
 
 
 parser = argparse.ArgumentParser(description="SteelSeries ChatMix Manager")
-parser.add_argument("command", choices=("status", "start", "stop", "restart", "enable", "disable", "install", "uninstall", "headsets", "daemon"), help="Command to execute [status, start, stop, restart, enable, disable, install, uninstall, headsets, daemon]")
+parser.add_argument("command", choices=("status", "start", "stop", "restart", "enable", "disable", "install", "uninstall", "headsets", "purge", "daemon", "stats", "levels", "relink", "reload", "record", "replay"), help="Command to execute [status, start, stop, restart, enable, disable, install, uninstall, purge, headsets, daemon, stats, levels, relink, reload, record, replay]")
 parser.add_argument("subcommand", nargs="?", choices=("udev", "systemd"), help="Optional install/uninstall target: [udev, systemd] (defaults to both)")
-parser.add_argument("-d", "--device", help="Specify a device ID (vendor:product)")
+parser.add_argument("-d", "--device", action="append", help="Specify a device ID (vendor:product), may be given several times")
+parser.add_argument("-a", "--all-users", action="store_true", help="Install, uninstall or purge for every desktop user (uid 1000 and up with a home directory) instead of the sudo user")
 parser.add_argument("-f", "--force", action="store_true", help="Force the operation (e.g., overwrite existing files)")
-args = parser.parse_args()
+parser.add_argument("-b", "--backend", choices=("auto", "native", "pactl"), default="auto", help="How the daemon sets sink volumes: native audio server connection or pactl processes (default: auto)")
+parser.add_argument("--hotplug", choices=("netlink", "poll"), default="netlink", help="How the daemon waits for a headset to be plugged in: udev netlink events or polling every 3 seconds (default: netlink)")
+parser.add_argument("--graph", choices=("sinks", "mixer"), default="sinks", help="Audio graph built per headset: Game and Chat null sinks linked to the headset, or a single filter-chain mixer node (default: sinks)")
+parser.add_argument("--keep-graph", action="store_true", help="Keep the virtual sinks when the daemon stops, so the next start reuses them without interrupting streams")
+parser.add_argument("--usb-mode", choices=("async", "sync"), default="async", help="Read the dial with queued asynchronous libusb transfers or blocking reads with a timeout (default: async)")
+parser.add_argument("--transfers", type=positive_int, default=4, help="Interrupt transfers kept in flight in async USB mode (default: 4)")
+parser.add_argument("--trace", help="Dial report trace written by record (may contain {location}, default: chatmix-{location}.trace) or read by replay")
+parser.add_argument("--speed", type=float, default=1.0, help="Replay speed relative to the recording, 0 for as fast as possible (default: 1)")
+parser.add_argument("--max-rate", type=float, default=50, help="Maximum volume updates per second sent to the audio server, 0 for unlimited (default: 50)")
+parser.add_argument("--log-target", choices=("auto", "stderr", "journal"), default="auto", help="Where the daemon logs: stderr or native journald fields (default: journal when stderr is connected to the journal)")
+parser.add_argument("--log-level", choices=("debug", "info", "warning", "error"), default="info", help="Lowest level logged by the daemon, debug also logs every dial report (default: info)")
+# parsed when run as a script; importing the module, e.g. from the benchmarks, doesn't need a command line
+args = None
 
 # SteelSeries USB VendorID
 VENDOR_ID = 0x1038
+# The systemd user unit running the one daemon of a user, for every headset model
+SERVICE_NAME = 'chatmix.service'
+# Reports sent on the dial interface, by report ID (the first byte): what they carry and their layout,
+# starting with the ID byte.  Only the ChatMix report is confirmed for every model; the battery and
+# mic mute reports are the layouts known from the Arctis Nova 7.
+ARCTIS_REPORTS = {
+    # game volume, chat volume in percent
+    0x45: ('chatmix', struct.Struct('<xBB')),
+    # battery level in percent
+    0xb7: ('battery', struct.Struct('<xB')),
+    # 1 when the microphone is muted
+    0xbb: ('mute', struct.Struct('<xB')),
+}
+
 # Known supported SteelSeries devices.  If it's not included here, it will still attempt to work automatically, but may enumerate devices wrong.
 STEELSERIES_DEVICES = {
     0x220e: {
         'name': 'Arctis 7+',
         'dial': 7,
+        'reports': ARCTIS_REPORTS,
     },
     0x2202: {
         'name': 'Arctis Nova 7',
         'dial': 8,
+        'reports': ARCTIS_REPORTS,
     },
     0x227a: {
         'name': 'Nova 7 WOW Edition ',
         'dial': 7,
+        'reports': ARCTIS_REPORTS,
     }
 }
 
 
+def load_json(path):
+    """Contents of a JSON state file, an empty dict if it is missing or unreadable"""
+    try:
+        return json.loads(path.read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def save_json(path, data, mode=0o777):
+    """Replace a JSON state file atomically, so readers never see half of it.  Errors are ignored:
+    these files only save work, without them it is done again.
+    """
+    try:
+        path.parent.mkdir(mode=mode, parents=True, exist_ok=True)
+        tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        tmp_path.write_text(json.dumps(data, indent=2, sort_keys=True))
+        tmp_path.replace(path)
+    except OSError:
+        pass
+
+
+class DeviceProfileCache:
+    """Persistent cache of what was learned about each headset model, keyed by vid:pid:bcdDevice:
+    its product string and the interface and endpoint of the ChatMix dial.
+
+    Reading these needs control transfers or walking every interface, so discovery reuses them instead.
+    An entry is dropped when the device descriptor no longer matches the one it was recorded with.
+    """
+
+    def __init__(self, path=None):
+        cache_home = os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache'
+        self.path = Path(path or Path(cache_home) / 'chatmix' / 'devices.json')
+        self.profiles = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(device):
+        return f'{device.idVendor:04x}:{device.idProduct:04x}:{device.bcdDevice:04x}'
+
+    @staticmethod
+    def fingerprint(device):
+        # fields of the device descriptor, which libusb already holds in memory
+        return (f'{device.bcdUSB:04x}:{device.bDeviceClass}:{device.bMaxPacketSize0}:{device.bNumConfigurations}:'
+                f'{device.iManufacturer}:{device.iProduct}:{device.iSerialNumber}')
+
+    def _load(self):
+        if self.profiles is None:
+            self.profiles = load_json(self.path)
+        return self.profiles
+
+    def _save(self):
+        save_json(self.path, self.profiles)
+
+    def get(self, device):
+        with self.lock:
+            profiles = self._load()
+            profile = profiles.get(self.key(device))
+            if profile is not None and profile.get('fingerprint') != self.fingerprint(device):
+                del profiles[self.key(device)]
+                self._save()
+                profile = None
+            return dict(profile or {})
+
+    def update(self, device, **fields):
+        with self.lock:
+            profiles = self._load()
+            profile = profiles.get(self.key(device), {})
+            if profile.get('fingerprint') != self.fingerprint(device):
+                profile = {'fingerprint': self.fingerprint(device)}
+            if all(profile.get(key) == value for key, value in fields.items()):
+                return
+            profile.update(fields)
+            profiles[self.key(device)] = profile
+            self._save()
+
+    def product(self, device):
+        """Product string of the device, only asked from the device the first time a model is seen"""
+        product = self.get(device).get('product')
+        if product is None:
+            product = usb.util.get_string(device, device.iProduct)
+            self.update(device, product=product)
+        return product
+
+
+device_profiles = DeviceProfileCache()
+
+
 def is_arctis_headset(device):
     try:
         if device.idProduct in STEELSERIES_DEVICES.keys():
             return True
-        return 'Arctis' in usb.util.get_string(device, device.iProduct) and '7' in usb.util.get_string(device, device.iProduct)
+        product = device_profiles.product(device)
+        return 'Arctis' in product and '7' in product
     except:
         return False
 
 
+# udev broadcasts device events on this netlink family once its rules have been applied
+NETLINK_KOBJECT_UEVENT = 15
+UDEV_MONITOR_GROUP = 2
+UDEV_MONITOR_MAGIC = 0xfeedcafe
+# offsets into libudev's monitor_netlink_header, whose filter fields are big endian like BPF loads
+UDEV_HEADER_MAGIC_OFF = 8
+UDEV_HEADER_SUBSYSTEM_HASH_OFF = 24
+UDEV_HEADER_DEVTYPE_HASH_OFF = 28
+SO_ATTACH_FILTER = 26
+BPF_LD_W_ABS = 0x20
+BPF_JEQ_K = 0x15
+BPF_RET_K = 0x06
+
+
+def murmur_hash2(data, seed=0):
+    """MurmurHash2 as used by libudev to hash the subsystem and devtype into the monitor header"""
+    m = 0x5bd1e995
+    h = (seed ^ len(data)) & 0xffffffff
+    tail = len(data) - len(data) % 4
+    for (k,) in struct.iter_unpack('=I', data[:tail]):
+        k = k * m & 0xffffffff
+        k ^= k >> 24
+        k = k * m & 0xffffffff
+        h = (h * m & 0xffffffff) ^ k
+    if tail < len(data):
+        for i, byte in enumerate(data[tail:]):
+            h ^= byte << (8 * i)
+        h = h * m & 0xffffffff
+    h ^= h >> 13
+    h = h * m & 0xffffffff
+    return h ^ (h >> 15)
+
+
+class HotplugMonitor:
+    """Blocks until a matching SteelSeries headset is plugged in, by listening to udev's netlink events.
+    A socket filter makes the kernel drop every event that isn't about a USB device, like libudev's
+    udev_monitor_filter_update(), so unrelated hotplug activity doesn't wake the process.
+    """
+
+    def __init__(self, device_ids=None):
+        if device_ids:
+            self.products = set()
+            for device_id in device_ids:
+                vendor, product = (int(i, 16) for i in device_id.split(':'))
+                self.products.add(f'{vendor:x}/{product:x}')
+        else:
+            self.products = {f'{VENDOR_ID:x}/{product:x}' for product in STEELSERIES_DEVICES}
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+        self.sock.bind((0, UDEV_MONITOR_GROUP))
+        self.attach_filter(b'usb', b'usb_device')
+
+    def attach_filter(self, subsystem, devtype):
+        """Only let udev messages whose header hashes match subsystem and devtype through"""
+        program = [
+            (BPF_LD_W_ABS, 0, 0, UDEV_HEADER_MAGIC_OFF),
+            (BPF_JEQ_K, 1, 0, UDEV_MONITOR_MAGIC),
+            (BPF_RET_K, 0, 0, 0),
+            (BPF_LD_W_ABS, 0, 0, UDEV_HEADER_SUBSYSTEM_HASH_OFF),
+            (BPF_JEQ_K, 0, 3, murmur_hash2(subsystem)),
+            (BPF_LD_W_ABS, 0, 0, UDEV_HEADER_DEVTYPE_HASH_OFF),
+            (BPF_JEQ_K, 0, 1, murmur_hash2(devtype)),
+            (BPF_RET_K, 0, 0, 0xffffffff),
+            (BPF_RET_K, 0, 0, 0),
+        ]
+        # struct sock_filter { u16 code; u8 jt; u8 jf; u32 k; }, the kernel copies it while attaching
+        filters = ctypes.create_string_buffer(b''.join(struct.pack('=HBBI', *insn) for insn in program))
+        self.sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER,
+                             struct.pack('HP', len(program), ctypes.addressof(filters)))
+
+    @staticmethod
+    def parse_event(data):
+        """Return the properties of a udev or kernel uevent message"""
+        if data.startswith(b'libudev\0'):
+            if struct.unpack_from('>I', data, 8)[0] != UDEV_MONITOR_MAGIC:
+                return {}
+            _, properties_off, properties_len = struct.unpack_from('=III', data, 12)
+            data = data[properties_off:properties_off + properties_len]
+        else:
+            # kernel messages start with an 'action@devpath' summary line
+            data = data.partition(b'\0')[2]
+        properties = {}
+        for line in data.split(b'\0'):
+            key, sep, value = line.decode('utf-8', 'replace').partition('=')
+            if sep:
+                properties[key] = value
+        return properties
+
+    def matches(self, event):
+        # PRODUCT is vendor/product/bcdDevice in lowercase hex without padding
+        return (event.get('ACTION') == 'add' and event.get('SUBSYSTEM') == 'usb'
+                and event.get('DEVTYPE') == 'usb_device'
+                and event.get('PRODUCT', '').rpartition('/')[0] in self.products)
+
+    def wait_for_headset(self, timeout=None):
+        """Return the properties of the next matching add event, or None if there was none within timeout seconds"""
+        deadline = None if timeout is None else monotonic() + timeout
+        while True:
+            self.sock.settimeout(None if deadline is None else max(0.0, deadline - monotonic()))
+            try:
+                event = self.parse_event(self.sock.recv(65536))
+            except TimeoutError:
+                return None
+            if self.matches(event):
+                return event
+
+    def close(self):
+        self.sock.close()
+
+
+LIBUSB_TRANSFER_TYPE_INTERRUPT = 3
+LIBUSB_TRANSFER_COMPLETED = 0
+LIBUSB_TRANSFER_CANCELLED = 3
+LIBUSB_ERROR_INTERRUPTED = -10
+
+
+class _LibusbTransfer(ctypes.Structure):
+    pass
+
+
+_LIBUSB_TRANSFER_CB = ctypes.CFUNCTYPE(None, ctypes.POINTER(_LibusbTransfer))
+_LibusbTransfer._fields_ = [
+    ('dev_handle', ctypes.c_void_p),
+    ('flags', ctypes.c_uint8),
+    ('endpoint', ctypes.c_ubyte),
+    ('type', ctypes.c_ubyte),
+    ('timeout', ctypes.c_uint),
+    ('status', ctypes.c_int),
+    ('length', ctypes.c_int),
+    ('actual_length', ctypes.c_int),
+    ('callback', _LIBUSB_TRANSFER_CB),
+    ('user_data', ctypes.c_void_p),
+    ('buffer', ctypes.POINTER(ctypes.c_ubyte)),
+    ('num_iso_packets', ctypes.c_int),
+]
+
+
+class AsyncInterruptReader:
+    """Keeps several libusb interrupt transfers queued on the dial endpoint, so there is no gap between reads
+    in which a report could be lost.  Completed reports are passed to on_report from the libusb event thread.
+
+    The transfers have no timeout: while the dial is idle nothing wakes up.  Uses the libusb library and
+    device handle PyUSB already opened, so it only works with PyUSB's libusb1 backend.
+    """
+
+    def __init__(self, device, interface, endpoint, transfers, on_report, size=64):
+        backend = device._ctx.backend
+        if not hasattr(backend, 'lib') or not hasattr(backend, 'ctx'):
+            raise ChatMixError(f'{type(backend).__name__} does not support asynchronous transfers')
+        self.lib = backend.lib
+        self.ctx = backend.ctx
+        self._setup_prototypes()
+        usb.util.claim_interface(device, interface)
+        self.device = device
+        self.interface = interface
+        self.on_report = on_report
+        self.callback = _LIBUSB_TRANSFER_CB(self._complete)
+        self.cancelled = False
+        self.error = None
+        self.active = 0
+        self.transfers = []
+        # keep the buffers referenced for as long as libusb may write into them
+        self.buffers = []
+        for _ in range(transfers):
+            transfer = self.lib.libusb_alloc_transfer(0)
+            if not transfer:
+                raise MemoryError('libusb_alloc_transfer failed')
+            buffer = (ctypes.c_ubyte * size)()
+            fields = transfer.contents
+            fields.dev_handle = device._ctx.handle.handle.value
+            fields.endpoint = endpoint
+            fields.type = LIBUSB_TRANSFER_TYPE_INTERRUPT
+            fields.timeout = 0
+            fields.length = size
+            fields.buffer = ctypes.cast(buffer, ctypes.POINTER(ctypes.c_ubyte))
+            fields.callback = self.callback
+            self.transfers.append(transfer)
+            self.buffers.append(buffer)
+
+    def _setup_prototypes(self):
+        transfer_p = ctypes.POINTER(_LibusbTransfer)
+        self.lib.libusb_alloc_transfer.argtypes = [ctypes.c_int]
+        self.lib.libusb_alloc_transfer.restype = transfer_p
+        self.lib.libusb_free_transfer.argtypes = [transfer_p]
+        self.lib.libusb_free_transfer.restype = None
+        self.lib.libusb_submit_transfer.argtypes = [transfer_p]
+        self.lib.libusb_submit_transfer.restype = ctypes.c_int
+        self.lib.libusb_cancel_transfer.argtypes = [transfer_p]
+        self.lib.libusb_cancel_transfer.restype = ctypes.c_int
+        self.lib.libusb_handle_events_completed.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_int)]
+        self.lib.libusb_handle_events_completed.restype = ctypes.c_int
+
+    def _complete(self, transfer):
+        fields = transfer.contents
+        if fields.status == LIBUSB_TRANSFER_COMPLETED and not self.cancelled:
+            try:
+                self.on_report(ctypes.string_at(fields.buffer, fields.actual_length))
+            except Exception:
+                logging.getLogger(__name__).exception('Error handling USB report')
+            result = self.lib.libusb_submit_transfer(transfer)
+            if result == 0:
+                return
+            self.error = result
+        elif fields.status not in (LIBUSB_TRANSFER_COMPLETED, LIBUSB_TRANSFER_CANCELLED):
+            self.error = fields.status
+        self.active -= 1
+        if self.error is not None:
+            self.cancel()
+
+    def run(self):
+        """Handle USB events until every transfer ended.  Returns the libusb error or transfer status that
+        ended reading (e.g. the device was unplugged), or None if it was cancelled.
+        """
+        for transfer in self.transfers:
+            result = self.lib.libusb_submit_transfer(transfer)
+            if result != 0:
+                self.error = result
+                self.cancel()
+                break
+            self.active += 1
+        completed = ctypes.c_int(0)
+        while self.active:
+            result = self.lib.libusb_handle_events_completed(self.ctx, ctypes.byref(completed))
+            if result not in (0, LIBUSB_ERROR_INTERRUPTED):
+                self.error = result
+                break
+        for transfer in self.transfers:
+            self.lib.libusb_free_transfer(transfer)
+        self.transfers = []
+        try:
+            usb.util.release_interface(self.device, self.interface)
+        except usb.core.USBError:
+            pass
+        return self.error
+
+    def cancel(self):
+        """Cancel the queued transfers, which makes run() return; safe to call from any thread"""
+        self.cancelled = True
+        for transfer in self.transfers:
+            self.lib.libusb_cancel_transfer(transfer)
+
+
+# PulseAudio native protocol constants.  pipewire-pulse speaks the same protocol on the same socket.
+PA_COMMAND_ERROR = 0
+PA_COMMAND_REPLY = 2
+PA_COMMAND_AUTH = 8
+PA_COMMAND_SET_CLIENT_NAME = 9
+PA_COMMAND_GET_SINK_INFO = 21
+PA_COMMAND_GET_SINK_INPUT_INFO = 29
+PA_COMMAND_SUBSCRIBE = 35
+PA_COMMAND_SET_SINK_VOLUME = 36
+PA_COMMAND_SUBSCRIBE_EVENT = 66
+PA_COMMAND_MOVE_SINK_INPUT = 67
+PA_SUBSCRIPTION_MASK_SINK = 0x0001
+PA_SUBSCRIPTION_MASK_SINK_INPUT = 0x0004
+PA_SUBSCRIPTION_EVENT_SINK = 0x00
+PA_SUBSCRIPTION_EVENT_SINK_INPUT = 0x02
+PA_SUBSCRIPTION_EVENT_FACILITY_MASK = 0x0f
+PA_SUBSCRIPTION_EVENT_TYPE_MASK = 0x30
+PA_SUBSCRIPTION_EVENT_NEW = 0x00
+PA_SUBSCRIPTION_EVENT_CHANGE = 0x10
+PA_SUBSCRIPTION_EVENT_REMOVE = 0x20
+PA_PROTOCOL_VERSION = 32
+PA_INVALID_INDEX = 0xffffffff
+PA_VOLUME_NORM = 0x10000
+PA_PACKET_HEADER = struct.Struct('>IIIII')
+
+
+class PulseError(Exception):
+    pass
+
+
+class TagStruct:
+    """Reader for the tagged values that make up the payload of a native protocol packet"""
+
+    def __init__(self, data):
+        self.raw = data
+        self.data = memoryview(data)
+        self.pos = 0
+
+    def _take(self, n):
+        chunk = self.data[self.pos:self.pos + n]
+        if len(chunk) != n:
+            raise PulseError('Truncated tagstruct')
+        self.pos += n
+        return chunk
+
+    def _u8(self):
+        return self._take(1)[0]
+
+    def _u32(self):
+        return struct.unpack('>I', self._take(4))[0]
+
+    def _u64(self):
+        return struct.unpack('>Q', self._take(8))[0]
+
+    def _string(self):
+        end = self.raw.index(b'\0', self.pos)
+        value = bytes(self._take(end - self.pos)).decode('utf-8', 'replace')
+        self.pos += 1
+        return value
+
+    def eof(self):
+        return self.pos >= len(self.data)
+
+    def read(self):
+        tag = chr(self._u8())
+        if tag == 't':
+            return self._string()
+        if tag == 'N':
+            return None
+        if tag in 'LV':
+            return self._u32()
+        if tag == 'B':
+            return self._u8()
+        if tag in 'RrU':
+            return self._u64()
+        if tag == '1':
+            return True
+        if tag == '0':
+            return False
+        if tag == 'a':
+            return {'format': self._u8(), 'channels': self._u8(), 'rate': self._u32()}
+        if tag == 'x':
+            return bytes(self._take(self._u32()))
+        if tag == 'T':
+            return (self._u32(), self._u32())
+        if tag == 'm':
+            return list(self._take(self._u8()))
+        if tag == 'v':
+            return [self._u32() for _ in range(self._u8())]
+        if tag == 'P':
+            proplist = {}
+            while True:
+                key = self.read()
+                if key is None:
+                    return proplist
+                length = self.read()
+                proplist[key] = self.read()[:length].rstrip(b'\0').decode('utf-8', 'replace')
+        if tag == 'f':
+            return {'encoding': self.read(), 'properties': self.read()}
+        raise PulseError(f'Unknown tag {tag!r} in tagstruct')
+
+    def read_all(self):
+        values = []
+        while not self.eof():
+            values.append(self.read())
+        return values
+
+
+def pa_u32(value):
+    return b'L' + struct.pack('>I', value)
+
+
+def pa_string(value):
+    if value is None:
+        return b'N'
+    return b't' + value.encode() + b'\0'
+
+
+def pa_arbitrary(value):
+    return b'x' + struct.pack('>I', len(value)) + value
+
+
+def pa_cvolume(volumes):
+    return b'v' + struct.pack(f'>B{len(volumes)}I', len(volumes), *volumes)
+
+
+def pa_proplist(props):
+    data = b'P'
+    for key, value in props.items():
+        value = value.encode() + b'\0'
+        data += pa_string(key) + pa_u32(len(value)) + pa_arbitrary(value)
+    return data + pa_string(None)
+
+
+class PulseClient:
+    """Long-lived connection to the PulseAudio native protocol socket.
+
+    Commands are pipelined: several requests can be written at once and their replies collected afterwards,
+    so a Game/Chat volume pair costs a single round trip and no process spawns.
+    """
+
+    def __init__(self, client_name='chatmix'):
+        self.client_name = client_name
+        self.sock = None
+        self.tag = 0
+        # subscription events that arrived while waiting for a reply
+        self.events = collections.deque()
+
+    @staticmethod
+    def socket_path():
+        server = os.environ.get('PULSE_SERVER', '')
+        match = re.search(r'(?:unix:)?(/\S+)', server)
+        if match:
+            return match.group(1)
+        runtime_dir = os.environ.get('XDG_RUNTIME_DIR', f'/run/user/{os.getuid()}')
+        return os.path.join(runtime_dir, 'pulse', 'native')
+
+    @staticmethod
+    def read_cookie():
+        home = Path.home()
+        for path in (os.environ.get('PULSE_COOKIE'), home / '.config' / 'pulse' / 'cookie', home / '.pulse-cookie'):
+            if path and Path(path).is_file():
+                return Path(path).read_bytes()[:256]
+        # pipewire-pulse doesn't check the cookie, send an empty one when there is none on disk
+        return bytes(256)
+
+    def connect(self):
+        self.close()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(self.socket_path())
+            self.request(PA_COMMAND_AUTH, pa_u32(PA_PROTOCOL_VERSION) + pa_arbitrary(self.read_cookie()))
+            self.request(PA_COMMAND_SET_CLIENT_NAME, pa_proplist({'application.name': self.client_name}))
+        except (OSError, PulseError) as e:
+            self.close()
+            raise PulseError(f'Unable to connect to {self.socket_path()}: {e}') from e
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def _packet(self, command, payload):
+        self.tag = (self.tag + 1) & 0xffffffff
+        body = pa_u32(command) + pa_u32(self.tag) + payload
+        return self.tag, PA_PACKET_HEADER.pack(len(body), 0xffffffff, 0, 0, 0) + body
+
+    def _recv_exact(self, n):
+        data = bytearray()
+        while len(data) < n:
+            chunk = self.sock.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError('Connection closed by audio server')
+            data += chunk
+        return data
+
+    def read_packet(self):
+        """Read the next command packet, returning (command, tag, TagStruct of the remaining payload)"""
+        while True:
+            length, channel, _, _, _ = PA_PACKET_HEADER.unpack(self._recv_exact(PA_PACKET_HEADER.size))
+            payload = self._recv_exact(length)
+            # memblock packets are only sent for streams, which we never create
+            if channel != 0xffffffff:
+                continue
+            ts = TagStruct(payload)
+            return ts.read(), ts.read(), ts
+
+    def _wait_reply(self, tag):
+        while True:
+            command, reply_tag, ts = self.read_packet()
+            if command == PA_COMMAND_SUBSCRIBE_EVENT:
+                self.events.append((ts.read(), ts.read()))
+                continue
+            if reply_tag != tag:
+                continue
+            if command == PA_COMMAND_ERROR:
+                raise PulseError(f'Audio server returned error {ts.read()}')
+            if command != PA_COMMAND_REPLY:
+                raise PulseError(f'Unexpected command {command} in reply')
+            return ts
+
+    def request(self, command, payload=b''):
+        return self.request_many([(command, payload)])[0]
+
+    def request_many(self, requests):
+        """Send several commands in one write and return the reply of each, in order"""
+        tags, data = [], b''
+        for command, payload in requests:
+            tag, packet = self._packet(command, payload)
+            tags.append(tag)
+            data += packet
+        self.sock.sendall(data)
+        return [self._wait_reply(tag) for tag in tags]
+
+    def subscribe(self, mask):
+        """Ask the server to send events for the facilities in mask, read them with next_event()"""
+        self.events.clear()
+        self.request(PA_COMMAND_SUBSCRIBE, pa_u32(mask))
+
+    def next_event(self):
+        """Block until the next subscription event, returning (facility, event type, object index)"""
+        while not self.events:
+            command, _, ts = self.read_packet()
+            if command == PA_COMMAND_SUBSCRIBE_EVENT:
+                self.events.append((ts.read(), ts.read()))
+        event, index = self.events.popleft()
+        return event & PA_SUBSCRIPTION_EVENT_FACILITY_MASK, event & PA_SUBSCRIPTION_EVENT_TYPE_MASK, index
+
+    def sink_name(self, index):
+        ts = self.request(PA_COMMAND_GET_SINK_INFO, pa_u32(index) + pa_string(None))
+        ts.read()
+        return ts.read()
+
+    def has_sink(self, name):
+        try:
+            self.request(PA_COMMAND_GET_SINK_INFO, pa_u32(PA_INVALID_INDEX) + pa_string(name))
+        except PulseError:
+            return False
+        return True
+
+    def sink_input_props(self, index):
+        """Property list of a sink input (application.name, media.role...)"""
+        ts = self.request(PA_COMMAND_GET_SINK_INPUT_INFO, pa_u32(index))
+        # index, name, module, client, sink, sample spec, channel map, volume, latencies, resample method, driver, muted
+        for _ in range(13):
+            ts.read()
+        return ts.read()
+
+    def move_sink_input(self, index, sink):
+        self.request(PA_COMMAND_MOVE_SINK_INPUT, pa_u32(index) + pa_u32(PA_INVALID_INDEX) + pa_string(sink))
+
+    def set_sink_volumes(self, volumes, channels=2):
+        """Set the volume, in percent, of each named sink"""
+        requests = []
+        for sink, percent in volumes.items():
+            volume = round(percent * PA_VOLUME_NORM / 100)
+            requests.append((PA_COMMAND_SET_SINK_VOLUME, pa_u32(PA_INVALID_INDEX) + pa_string(sink) + pa_cvolume([volume] * channels)))
+        self.request_many(requests)
+
+
+class PactlVolumeBackend:
+    """Sets sink volumes by running pactl, one process per sink"""
+    name = 'pactl'
+    reconnects = 0
+
+    def set_volumes(self, volumes):
+        for sink, percent in volumes.items():
+            subprocess.run(['pactl', 'set-sink-volume', sink, f'{percent}%'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def close(self):
+        pass
+
+
+class NativeVolumeBackend:
+    """Sets sink volumes over a persistent native protocol connection, reconnecting once if it drops"""
+    name = 'native'
+
+    def __init__(self):
+        self.client = PulseClient('chatmix')
+        self.client.connect()
+        self.reconnects = 0
+
+    def set_volumes(self, volumes):
+        try:
+            self.client.set_sink_volumes(volumes)
+        except OSError:
+            self.reconnects += 1
+            self.client.connect()
+            self.client.set_sink_volumes(volumes)
+
+    def close(self):
+        self.client.close()
+
+
+# One builtin mixer per output channel, each mixing the Game and Chat signal of that channel
+MIXER_CHANNELS = ('mix_l', 'mix_r')
+
+
+def mixer_config(node, description, inputs=2):
+    """PipeWire config for a process hosting a filter-chain that mixes `inputs` stereo pairs into one stereo output.
+
+    The capture side is a single sink with a channel pair per input (FL FR for the first, AUX0 AUX1, AUX2 AUX3...
+    for the next ones) and the gain of each input is a Props param, "mix_l:Gain 1" etc.  The playback side isn't
+    connected automatically, the caller links it to the headset.
+    """
+    positions = ['FL', 'FR'] + [f'AUX{channel}' for channel in range(2 * (inputs - 1))]
+    controls = ' '.join(f'"Gain {number}" = 1.0' for number in range(1, inputs + 1))
+    mixers = '\n'.join(f'                    {{ type = builtin name = {mixer} label = mixer control = {{ {controls} }} }}' for mixer in MIXER_CHANNELS)
+    ports = ' '.join(f'"{mixer}:In {number}"' for number in range(1, inputs + 1) for mixer in MIXER_CHANNELS)
+    return f'''context.properties = {{ log.level = 0 }}
+context.spa-libs = {{
+    audio.convert.* = audioconvert/libspa-audioconvert
+    support.*       = support/libspa-support
+}}
+context.modules = [
+    {{ name = libpipewire-module-rt flags = [ ifexists nofail ] }}
+    {{ name = libpipewire-module-protocol-native }}
+    {{ name = libpipewire-module-client-node }}
+    {{ name = libpipewire-module-adapter }}
+    {{ name = libpipewire-module-filter-chain
+        args = {{
+            node.description = "{description}"
+            media.name       = "{description}"
+            filter.graph = {{
+                nodes = [
+{mixers}
+                ]
+                inputs  = [ {ports} ]
+                outputs = [ {" ".join(f'"{mixer}:Out"' for mixer in MIXER_CHANNELS)} ]
+            }}
+            capture.props = {{
+                node.name      = "{node}"
+                media.class    = Audio/Sink
+                audio.position = [ {" ".join(positions)} ]
+            }}
+            playback.props = {{
+                node.name      = "{node}_output"
+                node.passive   = true
+                node.autoconnect = false
+                audio.position = [ FL FR ]
+            }}
+        }}
+    }}
+]
+'''
+
+
+class MixerError(Exception):
+    pass
+
+
+class MixerVolumeBackend:
+    """Sets the input gains of a filter-chain mixer node through a persistent pw-cli session,
+    restarting it once if it exits.  pw-cli doesn't answer set-param, so the errors it prints are
+    collected in the background and raised by the next set_volumes() call.
+    """
+    name = 'mixer'
+
+    def __init__(self, node, inputs):
+        self.node = node
+        # sink name -> mixer input number, in the same order as the mixer config's inputs
+        self.inputs = inputs
+        self.reconnects = 0
+        self.errors = collections.deque()
+        self.pw_cli = self._start()
+
+    def _start(self):
+        pw_cli = subprocess.Popen(['pw-cli'], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        threading.Thread(target=self._read_errors, args=(pw_cli.stderr,), daemon=True).start()
+        return pw_cli
+
+    def _read_errors(self, stderr):
+        # pw-cli reports bad commands as 'Error: "..."' and rejected params as 'remote error: ...'
+        for line in stderr:
+            if 'error' in line.lower():
+                self.errors.append(line.strip())
+
+    def set_volumes(self, volumes):
+        params = []
+        for sink, percent in volumes.items():
+            # sink volumes are cubic, so the dial sounds the same as in sinks mode
+            gain = (percent / 100) ** 3
+            for channel in MIXER_CHANNELS:
+                params.append(f'"{channel}:Gain {self.inputs[sink]}" {gain:.6f}')
+        command = f'set-param {self.node} Props {{ params = [ {" ".join(params)} ] }}\n'
+        try:
+            self.pw_cli.stdin.write(command)
+            self.pw_cli.stdin.flush()
+        except OSError:
+            self.reconnects += 1
+            self.pw_cli.kill()
+            self.pw_cli = self._start()
+            self.pw_cli.stdin.write(command)
+            self.pw_cli.stdin.flush()
+        errors = []
+        while self.errors:
+            errors.append(self.errors.popleft())
+        if errors:
+            raise MixerError(f'pw-cli: {"; ".join(errors)}')
+
+    def close(self):
+        try:
+            self.pw_cli.stdin.close()
+            self.pw_cli.wait(timeout=2)
+        except (OSError, subprocess.TimeoutExpired):
+            self.pw_cli.kill()
+
+
+VOLUME_BACKENDS = {
+    'native': NativeVolumeBackend,
+    'pactl': PactlVolumeBackend,
+}
+
+
+def is_chatmix_node(name):
+    """Whether a sink is one of the nodes the daemon creates rather than a real output"""
+    return name.startswith(('Arctis_Game_', 'Arctis_Chat_', 'Arctis_ChatMix_'))
+
+
+# Stream properties routing rules can match on, in order of precedence
+ROUTE_PROPERTIES = ('application.process.binary', 'application.name', 'media.role')
+ROUTE_TARGETS = ('game', 'chat')
+
+
+def compile_routes(rules):
+    """Turn the routes setting, a list like [{"application.name": "Discord", "to": "chat"}], into a
+    {(property, casefolded value): target} index so matching a stream is a dict lookup per property
+    """
+    if not isinstance(rules, list):
+        raise TypeError('routes must be a list')
+    routes = {}
+    for rule in rules:
+        if not isinstance(rule, dict) or rule.get('to') not in ROUTE_TARGETS:
+            raise ValueError(f'{rule!r} needs "to": "game" or "chat"')
+        matches = [key for key in rule if key != 'to']
+        if len(matches) != 1 or matches[0] not in ROUTE_PROPERTIES or not isinstance(rule[matches[0]], str):
+            raise ValueError(f'{rule!r} must match exactly one of {", ".join(ROUTE_PROPERTIES)}')
+        routes[(matches[0], rule[matches[0]].casefold())] = rule['to']
+    return routes
+
+
+def route_target(routes, props):
+    """Target of the first rule matching a stream's properties, None if no rule does"""
+    for key in ROUTE_PROPERTIES:
+        value = props.get(key)
+        if value is not None:
+            target = routes.get((key, value.casefold()))
+            if target:
+                return target
+    return None
+
+
+class SinkWatcher:
+    """Follows sink events on the audio server, so headsets are re-linked when their sink is recreated
+    (profile switch, suspend/resume, WirePlumber restart) without polling or rebuilding the VACs.
+
+    Sinks that go away are only noted; the links are restored when a sink with the same name, or another
+    Arctis sink if the name changed, shows up again.
+
+    New streams (sink inputs) matching the routing rules are moved to the Game or Chat sink as soon as they appear.
+    """
+    events = PA_SUBSCRIPTION_MASK_SINK | PA_SUBSCRIPTION_MASK_SINK_INPUT
+
+    def __init__(self, manager):
+        self.mgr = manager
+        self.log = logging.getLogger(__name__)
+        self.client = PulseClient('chatmix-watcher')
+        self.client.connect()
+        self.client.subscribe(self.events)
+        self.closed = False
+        self.reconnects = 0
+        self.routed = 0
+        self.thread = threading.Thread(target=self._run, name='chatmix-sink-watcher', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.closed:
+            try:
+                facility, kind, index = self.client.next_event()
+                if facility == PA_SUBSCRIPTION_EVENT_SINK_INPUT:
+                    if kind == PA_SUBSCRIPTION_EVENT_NEW and settings.routes:
+                        self._route(index)
+                    continue
+                if facility != PA_SUBSCRIPTION_EVENT_SINK:
+                    continue
+                if kind == PA_SUBSCRIPTION_EVENT_REMOVE:
+                    self._sink_removed()
+                elif kind == PA_SUBSCRIPTION_EVENT_NEW:
+                    try:
+                        name = self.client.sink_name(index)
+                    except PulseError:
+                        # already gone again
+                        continue
+                    if not is_chatmix_node(name):
+                        self._sink_added(name)
+            except (OSError, PulseError) as e:
+                if self.closed:
+                    return
+                self.log.warning(f"Lost audio server events ({e}), reconnecting...")
+                self._reconnect()
+
+    def _services(self):
+        with self.mgr.lock:
+            return [service for service in self.mgr.all_services() if service.sink]
+
+    def _sink_removed(self):
+        # remove events only carry the index, which we never learnt for the headset sinks; ask for them by name
+        for service in self._services():
+            if not service.sink_lost and not self.client.has_sink(service.sink):
+                service.sink_lost = True
+                self.log.warning(f"{service.sink} of {service.headset} disappeared, waiting for it to return")
+
+    def _sink_added(self, name):
+        services = self._services()
+        claimed = {service.sink for service in services if not service.sink_lost}
+        for service in services:
+            if service.sink == name:
+                service.relink(name)
+                return
+        if not re.match('.*[aA]rctis.*7', name) or name in claimed:
+            return
+        lost = [service for service in services if service.sink_lost]
+        # a sink that was renamed, e.g. by a profile switch: prefer the headset whose serial is in the name
+        lost.sort(key=lambda service: not (service.headset.serial and service.headset.serial in name))
+        if lost:
+            lost[0].relink(name)
+
+    def _route(self, index):
+        try:
+            props = self.client.sink_input_props(index)
+        except PulseError:
+            # already gone again
+            return
+        target = route_target(settings.routes, props)
+        if not target:
+            return
+        with self.mgr.lock:
+            # streams go to the first headset, like the default sink
+            services = list(self.mgr.services.values())
+        sink = services[0].route_sink(target) if services else None
+        if not sink:
+            return
+        application = props.get('application.name') or props.get('application.process.binary') or f'stream {index}'
+        try:
+            self.client.move_sink_input(index, sink)
+        except PulseError as e:
+            self.log.warning(f"Could not move {application} to {sink}: {e}")
+            return
+        self.routed += 1
+        self.log.info(f"Moved {application} to {sink}")
+
+    def _reconnect(self):
+        while not self.closed:
+            sleep(1)
+            try:
+                self.client.connect()
+                self.client.subscribe(self.events)
+            except PulseError:
+                continue
+            self.reconnects += 1
+            # sinks may have been recreated while we weren't listening; linking is idempotent so just link again
+            for service in self._services():
+                if self.client.has_sink(service.sink):
+                    service.relink(service.sink)
+                else:
+                    service.sink_lost = True
+            return
+
+    def close(self):
+        self.closed = True
+        if self.client.sock:
+            # wake the watcher thread from its blocking read
+            try:
+                self.client.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.client.close()
+
+
+class Histogram:
+    """Fixed-bucket histogram of durations in seconds"""
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        """Upper bound of the bucket holding the q-th quantile (0 < q <= 1)"""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return 'no samples'
+        return (f"n={self.count} avg={self.sum / self.count * 1000:.2f}ms p50<={self.percentile(0.5) * 1000:g}ms "
+                f"p99<={self.percentile(0.99) * 1000:g}ms max={self.max * 1000:.2f}ms")
+
+
+class Metrics:
+    """Builds a Prometheus text exposition.  Values are collected from the daemon when scraped,
+    so the read loop only ever increments plain attributes.
+    """
+
+    def __init__(self):
+        self.lines = []
+        self.declared = set()
+
+    def _declare(self, name, kind, help_text):
+        if name not in self.declared:
+            self.declared.add(name)
+            self.lines.append(f'# HELP {name} {help_text}')
+            self.lines.append(f'# TYPE {name} {kind}')
+
+    @staticmethod
+    def _labels(labels, **extra):
+        labels = {**labels, **extra}
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+    def counter(self, name, help_text, value, **labels):
+        self._declare(name, 'counter', help_text)
+        self.lines.append(f'{name}{self._labels(labels)} {value}')
+
+    def gauge(self, name, help_text, value, **labels):
+        self._declare(name, 'gauge', help_text)
+        self.lines.append(f'{name}{self._labels(labels)} {value}')
+
+    def histogram(self, name, help_text, histogram, **labels):
+        self._declare(name, 'histogram', help_text)
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            self.lines.append(f'{name}_bucket{self._labels(labels, le=bound)} {cumulative}')
+        self.lines.append(f'{name}_bucket{self._labels(labels, le="+Inf")} {histogram.count}')
+        self.lines.append(f'{name}_sum{self._labels(labels)} {histogram.sum}')
+        self.lines.append(f'{name}_count{self._labels(labels)} {histogram.count}')
+
+    def render(self):
+        return '\n'.join(self.lines) + '\n'
+
+
+def process_uptime():
+    """Seconds since this process was started, including interpreter startup"""
+    with open('/proc/self/stat') as f:
+        # fields after the parenthesised command name; starttime is the 22nd field overall
+        fields = f.read().rpartition(')')[2].split()
+    return time.clock_gettime(time.CLOCK_BOOTTIME) - int(fields[19]) / os.sysconf('SC_CLK_TCK')
+
+
+JOURNAL_SOCKET = '/run/systemd/journal/socket'
+# syslog priorities of the logging levels
+JOURNAL_PRIORITIES = {logging.DEBUG: 7, logging.INFO: 6, logging.WARNING: 4, logging.ERROR: 3, logging.CRITICAL: 2}
+
+
+class JournalHandler(logging.Handler):
+    """Sends records to journald with their own fields (priority, code location, thread, logger) instead of as stderr lines.
+    Extra fields can be given with extra={'journal': {'NAME': value}}.
+    """
+
+    def __init__(self, identifier='chatmix', path=JOURNAL_SOCKET):
+        super().__init__()
+        self.identifier = identifier
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM | socket.SOCK_CLOEXEC)
+
+    @staticmethod
+    def _field(name, value):
+        value = str(value).encode()
+        if b'\n' not in value:
+            return name.encode() + b'=' + value + b'\n'
+        # multi-line values are sent length-prefixed
+        return name.encode() + b'\n' + struct.pack('<Q', len(value)) + value + b'\n'
+
+    def emit(self, record):
+        try:
+            fields = {
+                'MESSAGE': self.format(record),
+                'PRIORITY': JOURNAL_PRIORITIES.get(record.levelno, 6),
+                'SYSLOG_IDENTIFIER': self.identifier,
+                'CODE_FILE': record.pathname,
+                'CODE_LINE': record.lineno,
+                'CODE_FUNC': record.funcName,
+                'THREAD_NAME': record.threadName,
+                'LOGGER': record.name,
+                **getattr(record, 'journal', {}),
+            }
+            self._send(b''.join(self._field(name, value) for name, value in fields.items()))
+        except Exception:
+            self.handleError(record)
+
+    def _send(self, data):
+        try:
+            self.sock.sendto(data, self.path)
+        except OSError as e:
+            if e.errno != errno.EMSGSIZE:
+                raise
+            # too big for a datagram (tracebacks), journald takes a sealed memfd instead
+            fd = os.memfd_create('chatmix-log', os.MFD_CLOEXEC | os.MFD_ALLOW_SEALING)
+            try:
+                os.write(fd, data)
+                fcntl.fcntl(fd, fcntl.F_ADD_SEALS, fcntl.F_SEAL_SHRINK | fcntl.F_SEAL_GROW | fcntl.F_SEAL_WRITE | fcntl.F_SEAL_SEAL)
+                self.sock.sendmsg([], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, struct.pack('i', fd))], 0, self.path)
+            finally:
+                os.close(fd)
+
+    def close(self):
+        self.sock.close()
+        super().close()
+
+
+def stderr_is_journal():
+    """Whether systemd connected stderr to the journal, see JOURNAL_STREAM in systemd.exec(5)"""
+    stream = os.environ.get('JOURNAL_STREAM')
+    if not stream:
+        return False
+    try:
+        st = os.fstat(sys.stderr.fileno())
+    except (OSError, ValueError):
+        return False
+    return stream == f'{st.st_dev}:{st.st_ino}'
+
+
+_log_listener = None
+
+
+def setup_logging():
+    """Configure the module logger once.  Records are only put on a queue by the logging threads (USB readers, appliers),
+    a listener thread formats and writes them, so a slow terminal or journald never holds up reading the dial.
+    """
+    global _log_listener
+    log = logging.getLogger(__name__)
+    if _log_listener:
+        return log
+    target = args.log_target
+    if target == 'auto':
+        target = 'journal' if stderr_is_journal() and os.path.exists(JOURNAL_SOCKET) else 'stderr'
+    if target == 'journal':
+        handler = JournalHandler()
+        handler.setFormatter(logging.Formatter('%(message)s'))
+    else:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(levelname)8s | %(message)s'))
+    records = queue.SimpleQueue()
+    _log_listener = logging.handlers.QueueListener(records, handler)
+    _log_listener.start()
+    # flushes whatever is still queued on exit
+    atexit.register(_log_listener.stop)
+    log.setLevel(args.log_level.upper())
+    log.propagate = False
+    log.addHandler(logging.handlers.QueueHandler(records))
+    return log
+
+
+def daemon_socket_path(uid):
+    """Location of the daemon's local socket for the desktop user with this uid"""
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR') if uid == os.getuid() else None
+    return Path(runtime_dir or f'/run/user/{uid}') / 'chatmix' / 'chatmix.sock'
+
+
+class DaemonSocket:
+    """Answers HTTP requests on a Unix socket, e.g. `curl --unix-socket <path> http://localhost/metrics`.
+
+    routes are read with GET, actions change something and need a POST; both map a path to a callable
+    returning the response body.
+    """
+
+    def __init__(self, path, routes, actions=None):
+        self.path = path
+        self.routes = routes
+        self.actions = actions or {}
+        self.path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        if self.path.exists():
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(str(self.path))
+            except OSError:
+                # left behind by a daemon that didn't exit cleanly
+                self.path.unlink()
+            else:
+                raise ChatMixError(f'Another daemon is already running on {self.path}')
+            finally:
+                probe.close()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(str(self.path))
+        os.chmod(self.path, 0o600)
+        self.sock.listen()
+        threading.Thread(target=self._serve, name='chatmix-socket', daemon=True).start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            with conn:
+                try:
+                    self._handle(conn)
+                except Exception:
+                    logging.getLogger(__name__).debug('Error answering daemon socket request', exc_info=True)
+
+    def _handle(self, conn):
+        conn.settimeout(1)
+        request = b''
+        while b'\r\n\r\n' not in request and b'\n\n' not in request:
+            chunk = conn.recv(4096)
+            if not chunk:
+                break
+            request += chunk
+        method, _, rest = request.decode('utf-8', 'replace').partition(' ')
+        route = rest.split(' ', 1)[0]
+        handler = (self.actions if method == 'POST' else self.routes).get(route)
+        if handler is None:
+            if route in self.routes or route in self.actions:
+                status, body = '405 Method Not Allowed', f'{route} needs {"GET" if route in self.routes else "POST"}\n'
+            else:
+                status, body = '404 Not Found', f'Unknown path {route}\n'
+        else:
+            try:
+                status, body = '200 OK', handler()
+            except ChatMixError as e:
+                status, body = '500 Internal Server Error', f'{e}\n'
+            except Exception as e:
+                logging.getLogger(__name__).error(f'Daemon socket request {route} failed', exc_info=True)
+                status, body = '500 Internal Server Error', f'{e}\n'
+        body = body.encode()
+        conn.sendall(f'HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                     f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+
+    def close(self):
+        self.sock.close()
+        if self.path.exists():
+            self.path.unlink()
+
+
+def daemon_request(uid, route, method='GET', timeout=1.0):
+    """Request a route from the daemon of the given user.  Returns None if no daemon is listening,
+    raises ChatMixError with the daemon's answer if the request failed.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(str(daemon_socket_path(uid)))
+        sock.sendall(f'{method} {route} HTTP/1.0\r\n\r\n'.encode())
+        response = b''
+        while chunk := sock.recv(65536):
+            response += chunk
+    except OSError:
+        return None
+    finally:
+        sock.close()
+    head, _, body = response.partition(b'\r\n\r\n')
+    if not head.startswith(b'HTTP/1.0 '):
+        return None
+    if not head.startswith(b'HTTP/1.0 200'):
+        raise ChatMixError(body.decode().strip())
+    return body.decode()
+
+
+def config_path():
+    config_home = os.environ.get('XDG_CONFIG_HOME') or Path.home() / '.config'
+    return Path(config_home) / 'chatmix' / 'config.json'
+
+
+# Daemon settings that can be changed in the config file and reloaded while running, with their type
+CONFIG_SETTINGS = {
+    'max_rate': float,
+    'routes': compile_routes,
+}
+
+
+def load_config():
+    """Settings from the config file, an empty dict if there is none.  Raises ChatMixError if it is invalid."""
+    path = config_path()
+    try:
+        config = json.loads(path.read_text())
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        raise ChatMixError(f'Cannot read {path}: {e}')
+    if not isinstance(config, dict):
+        raise ChatMixError(f'{path} must contain a JSON object')
+    settings = {}
+    for key, value in config.items():
+        if key not in CONFIG_SETTINGS:
+            raise ChatMixError(f'Unknown setting {key} in {path}')
+        try:
+            settings[key] = CONFIG_SETTINGS[key](value)
+        except (TypeError, ValueError) as e:
+            raise ChatMixError(f'Invalid {key} in {path}: {e}')
+    return settings
+
+
+class Settings:
+    """Settings the config file can change.  Each is the config file's value if it has one, otherwise the
+    command line's, so removing a setting from the file and reloading brings back the command line value.
+    """
+    # settings that only come from the config file
+    defaults = {'routes': {}}
+
+    def __init__(self):
+        self.config = {}
+
+    def __getattr__(self, name):
+        if name in self.config:
+            return self.config[name]
+        if name in self.defaults:
+            return self.defaults[name]
+        return getattr(args, name)
+
+
+settings = Settings()
+
+
+class GraphState:
+    """Record of the audio graph the daemon built for each headset, keyed by its USB location: the graph mode,
+    nodes, headset sink and links, plus the default sink to give back on a clean stop.
+
+    It lives in the runtime directory, so it survives daemon restarts but not a new login session, like the
+    nodes themselves.  An entry is only removed when its graph is destroyed.
+    """
+
+    def __init__(self, path=None):
+        self._path = path
+        self.entries = None
+        self.lock = threading.Lock()
+
+    @property
+    def path(self):
+        return Path(self._path or daemon_socket_path(os.getuid()).parent / 'graph.json')
+
+    def _load(self):
+        if self.entries is None:
+            self.entries = load_json(self.path)
+        return self.entries
+
+    def _save(self):
+        save_json(self.path, self.entries, mode=0o700)
+
+    def get(self, location):
+        with self.lock:
+            return dict(self._load().get('headsets', {}).get(location, {}))
+
+    def update(self, location, **fields):
+        with self.lock:
+            entries = self._load()
+            entries.setdefault('headsets', {}).setdefault(location, {}).update(fields)
+            self._save()
+
+    def remove(self, location):
+        with self.lock:
+            entries = self._load()
+            if entries.get('headsets', {}).pop(location, None) is not None:
+                if not entries['headsets']:
+                    entries.pop('default_sink', None)
+                self._save()
+
+    @property
+    def default_sink(self):
+        with self.lock:
+            return self._load().get('default_sink')
+
+    @default_sink.setter
+    def default_sink(self, sink):
+        with self.lock:
+            self._load()['default_sink'] = sink
+            self._save()
+
+
+graph_state = GraphState()
+
+
+# Dial report traces: a header, then fixed-size records so a trace can be appended to and indexed directly
+TRACE_MAGIC = b'CHATMIXT'
+TRACE_VERSION = 1
+# magic, version, record size, vendor id, product id, product name
+TRACE_HEADER = struct.Struct('<8sHHHH32s')
+# wall clock time in ns, report length, report (padded)
+TRACE_RECORD = struct.Struct('<qH6x64s')
+
+
+class TraceWriter:
+    """Appends the raw reports read from a headset to a trace file"""
+
+    def __init__(self, path, headset):
+        self.path = Path(path)
+        self.file = open(self.path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, TRACE_RECORD.size, headset.device.idVendor,
+                                              headset.device.idProduct, headset.name.encode()[:32]))
+        else:
+            # appending to a previous recording, which has to be of the same format
+            TraceReader(self.path).close()
+        self.records = 0
+
+    def write(self, stamp_ns, report):
+        report = bytes(report)
+        self.file.write(TRACE_RECORD.pack(stamp_ns, len(report), report))
+        self.records += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class TraceReader:
+    """Memory-mapped view of a trace; iterating yields (wall clock time in ns, report bytes)"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path, 'rb') as file:
+            try:
+                self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise ChatMixError(f'{path} is empty')
+        if len(self.map) < TRACE_HEADER.size:
+            self.close()
+            raise ChatMixError(f'{path} is not a ChatMix trace')
+        magic, version, record_size, self.vendor_id, self.product_id, name = TRACE_HEADER.unpack_from(self.map)
+        if magic != TRACE_MAGIC or version != TRACE_VERSION or record_size != TRACE_RECORD.size:
+            self.close()
+            raise ChatMixError(f'{path} is not a version {TRACE_VERSION} ChatMix trace')
+        self.name = name.rstrip(b'\0').decode(errors='replace')
+
+    def __len__(self):
+        # a record cut short by a crash while recording is ignored
+        return (len(self.map) - TRACE_HEADER.size) // TRACE_RECORD.size
+
+    def __getitem__(self, index):
+        stamp_ns, length, report = TRACE_RECORD.unpack_from(self.map, TRACE_HEADER.size + index * TRACE_RECORD.size)
+        return stamp_ns, report[:length]
+
+    def __iter__(self):
+        return (self[index] for index in range(len(self)))
+
+    def close(self):
+        self.map.close()
+
+
+class VolumeCoalescer:
+    """Holds the newest pending Game/Chat pair between the USB reader and the volume applier.
+
+    A newer report replaces a pending one that hasn't been applied yet, and reports that wouldn't change
+    anything are dropped.  Pairs are handed out no faster than max_rate per second.
+    """
+
+    def __init__(self, max_rate=0):
+        self.min_interval = 1 / max_rate if max_rate > 0 else 0
+        self.cond = threading.Condition()
+        self.pending = None
+        self.pending_stamp = None
+        self.taken_stamp = None
+        self.current = None
+        # what the sinks were last set to, for reporting; unlike current it survives failed() and reset()
+        self.last_levels = None
+        self.last_apply = 0.0
+        self.received = 0
+        self.coalesced = 0
+        self.skipped = 0
+        self.applied = 0
+
+    def submit(self, game, chat, stamp=None):
+        """Offer a new pair; stamp is the monotonic time its report was read, used for latency accounting"""
+        pair = (game, chat)
+        with self.cond:
+            self.received += 1
+            if pair == self.pending or (self.pending is None and pair == self.current):
+                self.skipped += 1
+                return
+            if self.pending is not None:
+                self.coalesced += 1
+            # moving back to the applied value cancels the pending update
+            self.pending = None if pair == self.current else pair
+            self.pending_stamp = stamp
+            self.cond.notify()
+
+    def due_in(self):
+        """Seconds until the pending pair may be applied, or None if nothing is pending"""
+        with self.cond:
+            if self.pending is None:
+                return None
+            return max(0.0, self.last_apply + self.min_interval - monotonic())
+
+    def take(self, timeout=None):
+        """Return the pending pair once the rate limit allows it, waiting up to timeout seconds (None waits forever)"""
+        deadline = None if timeout is None else monotonic() + timeout
+        with self.cond:
+            while True:
+                now = monotonic()
+                wait = None
+                if self.pending is not None:
+                    wait = self.last_apply + self.min_interval - now
+                    if wait <= 0:
+                        pair, self.pending = self.pending, None
+                        self.taken_stamp = self.pending_stamp
+                        self.current = self.last_levels = pair
+                        self.last_apply = now
+                        self.applied += 1
+                        return pair
+                if deadline is not None:
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        return None
+                    wait = remaining if wait is None else min(wait, remaining)
+                self.cond.wait(wait)
+
+    def set_max_rate(self, max_rate):
+        with self.cond:
+            self.min_interval = 1 / max_rate if max_rate > 0 else 0
+            self.cond.notify()
+
+    def levels(self):
+        """The Game/Chat pair last applied, or None"""
+        with self.cond:
+            return self.last_levels
+
+    def reset(self, max_rate):
+        """Start over for a reopened headset: drop the pending pair and apply the next one whatever it is.
+        The counters keep counting, they are totals over the life of the daemon.
+        """
+        with self.cond:
+            self.pending = self.pending_stamp = None
+            self.current = None
+            self.min_interval = 1 / max_rate if max_rate > 0 else 0
+            self.cond.notify()
+
+    def failed(self):
+        """Forget the last applied pair so the next report is applied even if it repeats it"""
+        with self.cond:
+            self.current = None
+
+    def stats(self):
+        with self.cond:
+            return {'received': self.received, 'applied': self.applied, 'coalesced': self.coalesced, 'skipped': self.skipped}
+
+
+class ChatMixError(RuntimeError):
+    """Fatal failure of the ChatMix service of a single headset"""
+
+
+class Headset:
+    """A connected SteelSeries headset and the names of the VAC pair created for it"""
+
+    def __init__(self, device):
+        self.device = device
+        self.product_id = device.idProduct
+        self.name = device_profiles.product(device)
+        self.id = self.name.lower().replace(' ', '')
+        # bus and port path identify the dongle even when several identical ones are plugged in
+        ports = '.'.join(str(port) for port in (device.port_numbers or ())) or str(device.address)
+        self.location = f'{device.bus}-{ports}'
+        self._name_nodes()
+
+    def _name_nodes(self):
+        node_id = re.sub(r'[^a-z0-9]', '', self.id.replace('+', 'plus'))
+        self.game_sink = f'Arctis_Game_{node_id}_{self.location}'
+        self.chat_sink = f'Arctis_Chat_{node_id}_{self.location}'
+        self.mixer_node = f'Arctis_ChatMix_{node_id}_{self.location}'
+
+    @functools.cached_property
+    def serial(self):
+        # unique per dongle, so it can't come from the profile cache; only fetched when needed
+        try:
+            return usb.util.get_string(self.device, self.device.iSerialNumber) if self.device.iSerialNumber else None
+        except (usb.core.USBError, ValueError):
+            return None
+
+    @property
+    def device_id(self):
+        return f'{self.device.idVendor:04x}:{self.device.idProduct:04x}'
+
+    def __str__(self):
+        return f'{self.name} ({self.device_id} on bus {self.location})'
+
+
+class TraceHeadset(Headset):
+    """Stands in for the headset a trace was recorded from, with its own VACs so it can replay next to real headsets"""
+
+    def __init__(self, trace):
+        self.device = trace
+        self.product_id = trace.product_id
+        self.name = trace.name
+        self.id = self.name.lower().replace(' ', '')
+        self.location = 'replay'
+        self.serial = None
+        self._name_nodes()
+
+    @property
+    def device_id(self):
+        return f'{self.device.vendor_id:04x}:{self.device.product_id:04x}'
+
+    def __str__(self):
+        return f'{self.name} ({self.device_id} replayed from {self.device.path})'
+
+
+class ModelHeadset(Headset):
+    """A known headset model that isn't plugged in, so its rules and unit can be provisioned ahead of time"""
+
+    def __init__(self, product_id):
+        self.device = None
+        self.product_id = product_id
+        self.name = STEELSERIES_DEVICES[product_id]['name'].strip()
+        self.id = self.name.lower().replace(' ', '')
+        self.location = None
+        self.serial = None
+        self._name_nodes()
+
+    @property
+    def device_id(self):
+        return f'{VENDOR_ID:04x}:{self.product_id:04x}'
+
+    def __str__(self):
+        return f'{self.name} ({self.device_id})'
+
+
+# Seconds between attempts to start a headset that failed, usually because its sink doesn't exist yet;
+# about 30s in total before the headset is given up on
+ATTACH_RETRY_DELAYS = (0.25, 0.5, 1, 2, 4, 8, 15)
+
+# Number of raw reports buffered between the USB reader and the applier before the oldest are dropped
+REPORT_QUEUE_SIZE = 64
+
+
 class Arctis7PlusChatMix:
     mgr = None
-    def __init__(self, manager: 'ChatMixManager'):
+    # without a matching Arctis sink there is nothing to route the VACs to
+    require_arctis_sink = True
+    # part of the daemon's audio graph: takes over the default sink and is recorded in the graph state
+    owns_graph = True
+
+    def __init__(self, manager: 'ChatMixManager', headset: Headset):
         self.mgr = manager
-        # set to receive signal from systemd for termination
-        signal.signal(signal.SIGTERM, self.__handle_sigterm)
+        self.headset = headset
+        self.device = headset.device
 
-        self.log = self._init_log()
-        self.log.info("Initializing a7chatmix...")
+        self.log = setup_logging()
+        # checked once instead of for every report
+        self.debug_reports = self.log.isEnabledFor(logging.DEBUG)
+        self.log.info(f"Initializing a7chatmix for {headset}...")
 
-        if not self.mgr.device:
+        # a trace without records is falsy, it's still a device
+        if self.device is None:
             raise RuntimeError('Error: installed headset not found.')
         if self.mgr.is_root:
             raise RuntimeError('Error: must be run as logged in desktop user.')
 
+        self._open_device()
+
+        started = monotonic()
+        self.VAC = self._init_VAC()
+        self.init_vac_seconds = monotonic() - started
+        self.mgr.vac_init.observe(self.init_vac_seconds)
+        self.volume = self._init_volume_backend()
+        self.coalescer = VolumeCoalescer(settings.max_rate)
+        self.reports = queue.Queue(REPORT_QUEUE_SIZE)
+        self.stopped = threading.Event()
+        self.async_reader = None
+        self.sink_lost = False
+        self.relinks = 0
+        self.reopens = 0
+        self.reports_dropped = 0
+        self.reports_read = 0
+        self.reports_ignored = 0
+        # state reported by the headset besides the dial, None until a report says otherwise
+        self.battery = None
+        self.mic_muted = None
+        self.report_table = self._build_report_table()
+        self.usb_timeouts = 0
+        self.volume_failures = 0
+        # time the reader spends between a read returning and the next read starting
+        self.reader_stall = Histogram()
+        # time from a report being read to its volumes being applied
+        self.apply_latency = Histogram()
+        self.trace = None
+        if self.mgr.trace_path:
+            path = Path(self.mgr.trace_path.replace('{location}', headset.location))
+            # the buffered writes of two headsets would tear each other's records, and the header is per headset
+            if any(service.trace and service.trace.path == path for service in self.mgr.all_services() if service is not self):
+                path = path.with_name(f'{path.stem}-{headset.location}{path.suffix}')
+            self.trace = TraceWriter(path, headset)
+            self.log.info(f"Recording dial reports to {path}")
+
+    def _open_device(self):
         # select its interface and USB endpoint, and capture the endpoint address
         try:
-            if STEELSERIES_DEVICES.get(self.mgr.device.idProduct, None):
-                self.interface = self.mgr.device[0].interfaces()[STEELSERIES_DEVICES.get(self.mgr.device.idProduct, None)['dial']]
+            profile = device_profiles.get(self.device)
+            if 'interface' in profile and 'endpoint' in profile:
+                self.interface_num = profile['interface']
+                self.addr = profile['endpoint']
             else:
-                # Attempts to select the interface of the ChatMix dial; usually this is the last enumerated HID interface.
-                self.interface = [i for i in self.mgr.device[0].interfaces() if i.bInterfaceClass == 3][-1]
-            self.interface_num = self.interface.bInterfaceNumber
-            self.endpoint = self.interface.endpoints()[0]
-            self.addr = self.endpoint.bEndpointAddress
+                if STEELSERIES_DEVICES.get(self.device.idProduct, None):
+                    interface = self.device[0].interfaces()[STEELSERIES_DEVICES.get(self.device.idProduct, None)['dial']]
+                else:
+                    # Attempts to select the interface of the ChatMix dial; usually this is the last enumerated HID interface.
+                    interface = [i for i in self.device[0].interfaces() if i.bInterfaceClass == 3][-1]
+                self.interface_num = interface.bInterfaceNumber
+                self.addr = interface.endpoints()[0].bEndpointAddress
+                device_profiles.update(self.device, interface=self.interface_num, endpoint=self.addr)
         except Exception as e:
             self.log.error("""Failure to identify relevant 
             USB device's interface or endpoint. Shutting down...""")
             self.die_gracefully(trigger="identification of USB endpoint")
 
         # detach if the device is active
-        if self.mgr.device.is_kernel_driver_active(self.interface_num):
-            self.mgr.device.detach_kernel_driver(self.interface_num)
-
-        self.VAC = self._init_VAC()
-
-    def _init_log(self):
-        log = logging.getLogger(__name__)
-        log.setLevel(logging.DEBUG)
-        stdout_handler = logging.StreamHandler()
-        stdout_handler.setLevel(logging.DEBUG)
-        stdout_handler.setFormatter(logging.Formatter('%(levelname)8s | %(message)s'))
-        log.addHandler(stdout_handler)
-        return log
+        if self.device.is_kernel_driver_active(self.interface_num):
+            self.device.detach_kernel_driver(self.interface_num)
+
+    def reopen(self, headset):
+        """Take over a replugged headset, reusing the VACs, links and audio connection kept since it was unplugged"""
+        self.headset = headset
+        self.device = headset.device
+        self.log.info(f"Reopening {headset}, keeping its VACs")
+        started = monotonic()
+        self._open_device()
+        self.coalescer.reset(settings.max_rate)
+        self.reports = queue.Queue(REPORT_QUEUE_SIZE)
+        self.async_reader = None
+        self.reopens += 1
+        self.start_modulator_signal()
+        self.log.info(f"Reopened in {(monotonic() - started) * 1000:.1f}ms")
 
     def _init_VAC(self):
         """Get name of default sink, establish virtual sink
-        and pipe its output to the default sink
-        """
+        and pipe its output to the default sink.
+
+        Independent steps run concurrently: the pactl queries run while a single pw-cli session
+        replaces the VAC nodes, then all monitor links are created in parallel.
 
-        # get the default sink id from pactl
-        self.system_default_sink = os.popen("pactl get-default-sink").read().strip()
-        self.log.info(f"default sink identified as {self.system_default_sink}")
+        If the state file says a previous run built this headset's sinks, the graph is reconciled
+        instead: nodes and links that still exist are kept and only missing ones are created, so
+        streams already playing into the VACs aren't interrupted.
+        """
+        game_sink, chat_sink = self.headset.game_sink, self.headset.chat_sink
+        state = graph_state.get(self.headset.location) if self.owns_graph else {}
+        # the mixer lives in a child process, so there is nothing left of it after a restart
+        warm = args.graph == 'sinks' and state.get('graph') == 'sinks'
+
+        pw_cli = None
+        if warm:
+            self.log.info("Reconciling VACs from a previous run...")
+            list_links = subprocess.Popen(['pw-link', '--links'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        else:
+            # Destroy virtual sinks if they already existed incase of previous failure,
+            # then instantiate our virtual sinks - Arctis_Chat and Arctis_Game
+            commands = [f'destroy {game_sink}', f'destroy {chat_sink}']
+            if args.graph == 'mixer':
+                self.log.info("Starting ChatMix mixer...")
+                self.mixer = self._start_mixer()
+            else:
+                self.log.info("Creating VACS...")
+                commands += [
+                    self._create_node_command(game_sink, f'{self.headset.name} Game'),
+                    self._create_node_command(chat_sink, f'{self.headset.name} Chat'),
+                ]
+            pw_cli = self._pw_cli_batch(commands)
+
+        # get the default sink id from pactl.  With several headsets only the first one attached records it,
+        # later ones would just see the previous headset's Game sink
+        list_sinks = subprocess.Popen(['pactl', 'list', 'short', 'sinks'], stdout=subprocess.PIPE, text=True)
+        if self.mgr.system_default_sink is None:
+            # after a restart the default is still our Game sink, use the one recorded by the previous run
+            self.mgr.system_default_sink = graph_state.default_sink
+            if self.mgr.system_default_sink is None:
+                get_default = subprocess.Popen(['pactl', 'get-default-sink'], stdout=subprocess.PIPE, text=True)
+                default = get_default.communicate()[0].strip()
+                if not is_chatmix_node(default):
+                    self.mgr.system_default_sink = default
+                    if self.owns_graph:
+                        graph_state.default_sink = default
+            self.log.info(f"default sink identified as {self.mgr.system_default_sink}")
 
         # attempt to identify an Arctis sink via pactl
         try:
-            pactl_short_sinks = os.popen("pactl list short sinks").readlines()
+            pactl_short_sinks = list_sinks.communicate()[0].splitlines()
+            # split the lines on tabs (which form table given by 'pactl short sinks'),
+            # skipping the first element of each line (sink's ID which is not persistent)
+            sinks = [re.split(r'\t', sink)[1] for sink in pactl_short_sinks if '\t' in sink]
             # grab any elements from list of pactl sinks that are Arctis 7
             arctis = re.compile('.*[aA]rctis.*7')
-            arctis_sink = list(filter(arctis.match, pactl_short_sinks))[0]
-
-            # split the arctis line on tabs (which form table given by 'pactl short sinks')
-            tabs_pattern = re.compile(r'\t')
-            tabs_re = re.split(tabs_pattern, arctis_sink)
-
-            # skip first element of tabs_re (sink's ID which is not persistent)
-            arctis_device = tabs_re[1]
+            arctis_devices = list(filter(arctis.match, sinks))
+            # prefer the sink used before, then the one named after this dongle's serial,
+            # otherwise the first one no other headset uses
+            # unplugged headsets' sinks are gone with them, a dongle replugged elsewhere brings its sink back
+            with self.mgr.lock:
+                claimed = {service.sink for service in self.mgr.services.values() if service is not self}
+            candidates = [device for device in arctis_devices if device not in claimed and not is_chatmix_node(device)]
+            candidates.sort(key=lambda device: (device != state.get('sink'), not self.headset.serial or self.headset.serial not in device))
+            if not candidates and not self.require_arctis_sink and self.mgr.system_default_sink:
+                candidates = [self.mgr.system_default_sink]
+            arctis_device = candidates[0]
             self.log.info(f"Arctis sink identified as {arctis_device}")
             default_sink = arctis_device
+            self.sink = arctis_device
 
         except Exception as e:
             self.log.error("""Something wrong with Arctis definition 
             in pactl list short sinks regex matching.
             Likely no match found for device, check traceback.
             """, exc_info=True)
+            if pw_cli:
+                pw_cli.wait()
             return self.die_gracefully(trigger="No Arctis device match")
 
-        # Destroy virtual sinks if they already existed incase of previous failure:
-        try:
-            destroy_a7p_game = os.system("pw-cli destroy Arctis_Game 2>/dev/null")
-            destroy_a7p_chat = os.system("pw-cli destroy Arctis_Chat 2>/dev/null")
-            if destroy_a7p_game == 0 or destroy_a7p_chat == 0:
-                raise Exception
-        except Exception as e:
-            self.log.info("""Attempted to destroy old VAC sinks at init but none existed""")
+        existing_links = set()
+        if warm:
+            missing = [(vac, role) for vac, role in ((game_sink, 'Game'), (chat_sink, 'Chat')) if vac not in sinks]
+            if missing:
+                self.log.info(f"Recreating {', '.join(vac for vac, _ in missing)}...")
+                pw_cli = self._pw_cli_batch([self._create_node_command(vac, f'{self.headset.name} {role}') for vac, role in missing])
+            existing_links = self._parse_links(list_links.communicate()[0])
 
-        # Instantiate our virtual sinks - Arctis_Chat and Arctis_Game
-        try:
-            self.log.info("Creating VACS...")
-            os.system(f"""pw-cli create-node adapter '{{ 
-                factory.name=support.null-audio-sink 
-                node.name=Arctis_Game 
-                node.description="{self.mgr.headset_name} Game" 
-                media.class=Audio/Sink 
-                monitor.channel-volumes=true 
-                object.linger=true 
-                audio.position=[FL FR]
-                }}' 1>/dev/null
-            """)
-
-            os.system(f"""pw-cli create-node adapter '{{ 
-                factory.name=support.null-audio-sink 
-                node.name=Arctis_Chat 
-                node.description="{self.mgr.headset_name} Chat" 
-                media.class=Audio/Sink 
-                monitor.channel-volumes=true 
-                object.linger=true 
-                audio.position=[FL FR]
-                }}' 1>/dev/null
-            """)
-        except Exception as E:
-            self.log.error("""Failure to create node adapter - 
-            Arctis_Chat virtual device could not be created""", exc_info=True)
-            self.die_gracefully(sink_creation_fail=True, trigger="VAC node adapter")
+        if pw_cli:
+            try:
+                pw_cli.wait(timeout=10)
+            except Exception as E:
+                pw_cli.kill()
+                self.log.error("""Failure to create node adapter - 
+                Arctis_Chat virtual device could not be created""", exc_info=True)
+                self.die_gracefully(sink_creation_fail=True, trigger="VAC node adapter")
+
+        # set the default sink to the Game sink of the first headset, while the links are being made;
+        # when reconciling it was set by the previous run, or deliberately changed since
+        set_default = None
+        if self.owns_graph and not warm and not self.mgr.all_services():
+            default = self.headset.mixer_node if args.graph == 'mixer' else game_sink
+            set_default = subprocess.Popen(['pactl', 'set-default-sink', default])
 
         # route the virtual sink's L&R channels to the default system output's LR
+        links = self._sink_links(default_sink)
         try:
-            self.log.info("Assigning VAC sink monitors output to default device...")
-
-            os.system(f'pw-link "Arctis_Game:monitor_FL" '
-                      f'"{default_sink}:playback_FL" 1>/dev/null')
-
-            os.system(f'pw-link "Arctis_Game:monitor_FR" '
-                      f'"{default_sink}:playback_FR" 1>/dev/null')
-
-            os.system(f'pw-link "Arctis_Chat:monitor_FL" '
-                      f'"{default_sink}:playback_FL" 1>/dev/null')
-
-            os.system(f'pw-link "Arctis_Chat:monitor_FR" '
-                      f'"{default_sink}:playback_FR" 1>/dev/null')
+            if args.graph == 'mixer':
+                self.log.info("Assigning mixer output to default device...")
+                # the mixer process needs a moment to connect, give its ports up to a second to appear
+                self._link_ports(links, attempts=50)
+            else:
+                missing_links = [link for link in links if link not in existing_links]
+                if missing_links:
+                    self.log.info("Assigning VAC sink monitors output to default device...")
+                    self._link_ports(missing_links)
 
         except Exception as e:
             self.log.error("""Couldn't create the links to 
             pipe LR from VAC to default device""", exc_info=True)
             self.die_gracefully(sink_fail=True, trigger="LR links")
 
-        # set the default sink to Arctis Game
-        os.system('pactl set-default-sink Arctis_Game')
+        if self.owns_graph:
+            graph_state.update(self.headset.location, graph=args.graph, sink=self.sink, links=links,
+                               nodes=[self.headset.mixer_node] if args.graph == 'mixer' else [game_sink, chat_sink])
+        if set_default:
+            set_default.wait()
+
+    @staticmethod
+    def _parse_links(output):
+        """Set of (output port, input port) pairs from `pw-link --links` output"""
+        links = set()
+        port = None
+        for line in output.splitlines():
+            if not line[:1].isspace():
+                port = line.strip()
+            elif line.strip().startswith('|->') and port:
+                links.add((port, line.strip()[3:].strip()))
+        return links
+
+    def _sink_links(self, sink):
+        """Links from this headset's VACs (or mixer) to the playback ports of its sink"""
+        if args.graph == 'mixer':
+            return [(f'{self.headset.mixer_node}_output:output_{channel}', f'{sink}:playback_{channel}') for channel in ('FL', 'FR')]
+        return [(f'{vac}:monitor_{channel}', f'{sink}:playback_{channel}')
+                for vac in (self.headset.game_sink, self.headset.chat_sink) for channel in ('FL', 'FR')]
+
+    def route_sink(self, target):
+        """Sink that streams routed to target, game or chat, are moved to; None if there is none"""
+        if args.graph == 'mixer':
+            # moving a stream to the mixer only reaches its Game input, chat streams have to be linked to AUX0/AUX1
+            return self.headset.mixer_node if target == 'game' else None
+        return self.headset.game_sink if target == 'game' else self.headset.chat_sink
+
+    def relink(self, sink):
+        """Link the VACs to the headset's sink again after the audio server recreated it, leaving the VACs alone"""
+        try:
+            self._link_ports(self._sink_links(sink))
+        except ChatMixError as e:
+            self.log.error(f"Could not relink {self.headset}: {e}")
+            return
+        if sink != self.sink:
+            self.log.info(f"Arctis sink of {self.headset} is now {sink}")
+            if self.owns_graph:
+                graph_state.update(self.headset.location, sink=sink, links=self._sink_links(sink))
+        self.sink = sink
+        self.sink_lost = False
+        self.relinks += 1
+        self.log.info(f"Relinked {self.headset} to {sink}")
+
+    @staticmethod
+    def _create_node_command(name, description):
+        return (f'create-node adapter {{ factory.name=support.null-audio-sink node.name={name} '
+                f'node.description="{description}" media.class=Audio/Sink monitor.channel-volumes=true '
+                f'object.linger=true audio.position=[FL FR] }}')
+
+    def _start_mixer(self):
+        """Run the filter-chain mixer of this headset in its own pipewire process, so it goes away with the daemon"""
+        config = daemon_socket_path(os.getuid()).parent / f'mixer-{self.headset.location}.conf'
+        config.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        config.write_text(mixer_config(self.headset.mixer_node, f'{self.headset.name} ChatMix'))
+        return subprocess.Popen(['pipewire', '-c', str(config)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    @staticmethod
+    def _pw_cli_batch(commands):
+        """Start one pw-cli session running all commands, instead of a process and connection per command"""
+        pw_cli = subprocess.Popen(['pw-cli'], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, text=True)
+        pw_cli.stdin.write(''.join(f'{command}\n' for command in commands))
+        pw_cli.stdin.close()
+        return pw_cli
+
+    @staticmethod
+    def _link_ports(links, attempts=10):
+        """Create all pw-link links in parallel, retrying those whose ports haven't appeared yet"""
+        for attempt in range(attempts):
+            procs = [(link, subprocess.Popen(['pw-link', *link], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)) for link in links]
+            failed = []
+            for link, proc in procs:
+                error = proc.communicate()[1]
+                if proc.returncode != 0 and 'File exists' not in error:
+                    failed.append(link)
+            if not failed:
+                return
+            links = failed
+            sleep(0.02)
+        raise ChatMixError(f'Could not link {", ".join(" -> ".join(link) for link in links)}')
+
+    def _init_volume_backend(self):
+        """Open the backend used to apply dial changes, falling back to pactl
+        when the audio server socket can't be reached
+        """
+        if args.graph == 'mixer':
+            backend = MixerVolumeBackend(self.headset.mixer_node, {self.headset.game_sink: 1, self.headset.chat_sink: 2})
+        elif args.backend == 'pactl':
+            backend = PactlVolumeBackend()
+        else:
+            try:
+                backend = NativeVolumeBackend()
+            except PulseError as e:
+                if args.backend == 'native':
+                    self.log.error(f"Could not connect to audio server: {e}")
+                    return self.die_gracefully(trigger="native volume backend")
+                self.log.warning(f"Native volume backend unavailable ({e}), falling back to pactl")
+                backend = PactlVolumeBackend()
+        self.log.info(f"Using {backend.name} volume backend")
+        return backend
 
     def start_modulator_signal(self):
         """Listen to the USB device for modulator knob's signal 
-        and adjust volume accordingly
+        and adjust volume accordingly.
+
+        A reader thread does nothing but block on USB and queue the reports; an applier thread
+        coalesces them and talks to the audio server, so audio server latency never delays a read.
         """
 
         self.log.info("Reading modulator USB input started")
         self.log.info("-" * 45)
-        self.log.info(f"{self.mgr.headset_name} ChatMix Enabled!")
+        self.log.info(f"{self.headset.name} ChatMix Enabled!")
         self.log.info("-" * 45)
-        while True:
+        self.ready_after = process_uptime()
+        self.log.info(f"Ready {self.ready_after * 1000:.0f}ms after process start, VAC setup took {self.init_vac_seconds * 1000:.0f}ms")
+        self.stopped.clear()
+        # the threads only belong to this headset; the main thread stays with the manager to handle SIGTERM and hotplug
+        self.reader = threading.Thread(target=self._read_reports, name=f'chatmix-reader-{self.headset.location}', daemon=True)
+        self.applier = threading.Thread(target=self._apply_reports, name=f'chatmix-applier-{self.headset.location}', daemon=True)
+        self.reader.start()
+        self.applier.start()
+
+    def _read_reports(self):
+        if args.usb_mode == 'async':
+            try:
+                self.async_reader = AsyncInterruptReader(self.device, self.interface_num, self.addr, args.transfers, self._on_report)
+            except (ChatMixError, AttributeError, OSError) as e:
+                self.log.warning(f"Asynchronous USB transfers unavailable ({e}), using synchronous reads")
+            else:
+                return self._read_reports_async()
+        self._read_reports_sync()
+
+    def _read_reports_async(self):
+        error = self.async_reader.run()
+        if error is not None and not self.stopped.is_set():
+            self.log.fatal(f"USB transfer error {error} on {self.headset.location} - likely disconnect")
+            self._enqueue(None)
+            self.mgr.detach(self)
+            return
+        self._enqueue(None)
+
+    def _build_report_table(self):
+        """Lookup table of (handler, unpack) indexed by report ID, None for reports that are ignored"""
+        handlers = {'chatmix': self._on_chatmix, 'battery': self._on_battery, 'mute': self._on_mute}
+        profile = STEELSERIES_DEVICES.get(self.headset.product_id)
+        if profile is None:
+            # report IDs of unlisted models are unknown, read any report as game, chat volume like the dial report
+            self.log.warning(f"{self.headset.name} is not a known model, treating every report as a ChatMix dial report")
+            return [(self._on_chatmix, ARCTIS_REPORTS[0x45][1].unpack_from)] * 256
+        layouts = profile.get('reports', ARCTIS_REPORTS)
+        table = [None] * 256
+        for report_id, (kind, layout) in layouts.items():
+            table[report_id] = (handlers[kind], layout.unpack_from)
+        return table
+
+    def _on_report(self, read_input):
+        received = monotonic()
+        self.reports_read += 1
+        if self.trace:
+            self.trace.write(time.time_ns(), read_input)
+        # parse in place, the report is never copied
+        report = memoryview(read_input)
+        if self.debug_reports:
+            self.log.debug(f"Report {report.hex(' ')} from {self.headset.location}",
+                           extra={'journal': {'CHATMIX_HEADSET': self.headset.location, 'CHATMIX_REPORT': report.hex()}})
+        entry = self.report_table[report[0]] if len(report) else None
+        if entry is None:
+            self.reports_ignored += 1
+        else:
+            handler, unpack = entry
+            try:
+                values = unpack(report)
+            except struct.error:
+                # shorter than its layout
+                self.reports_ignored += 1
+            else:
+                handler(received, *values)
+        self.reader_stall.observe(monotonic() - received)
+
+    def _on_chatmix(self, received, game, chat):
+        self._enqueue((received, game, chat))
+
+    def _on_battery(self, received, level):
+        if level != self.battery:
+            self.log.info(f"{self.headset.name} battery at {level}%")
+        self.battery = level
+
+    def _on_mute(self, received, muted):
+        muted = bool(muted)
+        if muted != self.mic_muted:
+            self.log.info(f"{self.headset.name} microphone {'muted' if muted else 'unmuted'}")
+        self.mic_muted = muted
+
+    def _read_reports_sync(self):
+        while not self.stopped.is_set():
             try:
                 # read the input of the USB signal. Signal is sent in 64-bit interrupt packets.
-                # read_input[1] returns value to use for default device volume
-                # read_input[2] returns the value to use for virtual device volume
-                read_input = self.mgr.device.read(self.addr, 64)
-                default_device_volume = "{}%".format(read_input[1])
-                virtual_device_volume = "{}%".format(read_input[2])
-
-                # os.system calls to issue the commands directly to pactl
-                os.system(f'pactl set-sink-volume Arctis_Game {default_device_volume}')
-                os.system(f'pactl set-sink-volume Arctis_Chat {virtual_device_volume}')
+                read_input = self.device.read(self.addr, 64)
             except usb.core.USBTimeoutError:
-                pass
+                self.usb_timeouts += 1
+                continue
             except usb.core.USBError:
-                self.log.fatal("USB input/output error - likely disconnect")
-                break
-            except KeyboardInterrupt:
-                self.die_gracefully()
-
-    def __handle_sigterm(self, sig, frame):
-        self.die_gracefully()
+                if self.stopped.is_set():
+                    break
+                self.log.fatal(f"USB input/output error on {self.headset.location} - likely disconnect")
+                self._enqueue(None)
+                self.mgr.detach(self)
+                return
+            self._on_report(read_input)
+        self._enqueue(None)
+
+    def _enqueue(self, item):
+        """Queue an item for the applier without ever blocking, dropping the oldest report if the queue is full"""
+        while True:
+            try:
+                self.reports.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self.reports.get_nowait()
+                    self.reports_dropped += 1
+                except queue.Empty:
+                    pass
+
+    def _apply_reports(self):
+        while True:
+            # while an update is held back by the rate limit, only wait for new reports until it is due
+            items = []
+            try:
+                items.append(self.reports.get(timeout=self.coalescer.due_in()))
+                while True:
+                    items.append(self.reports.get_nowait())
+            except queue.Empty:
+                pass
+            for item in items:
+                if item is None:
+                    return
+                received, game, chat = item
+                self.coalescer.submit(game, chat, received)
+            update = self.coalescer.take(timeout=0)
+            if update:
+                self.apply_volumes(*update)
+                self.apply_latency.observe(monotonic() - self.coalescer.taken_stamp)
+
+    def apply_volumes(self, game, chat):
+        try:
+            self.volume.set_volumes({self.headset.game_sink: game, self.headset.chat_sink: chat})
+        except (OSError, PulseError, MixerError) as e:
+            self.coalescer.failed()
+            self.volume_failures += 1
+            self.log.error(f"Failed to set sink volumes: {e}")
+
+    def collect_metrics(self, metrics):
+        labels = {'headset': self.headset.location, 'model': self.headset.id}
+        stats = self.coalescer.stats()
+        metrics.counter('chatmix_reports_read_total', 'Dial reports read from USB', self.reports_read, **labels)
+        metrics.counter('chatmix_usb_timeouts_total', 'USB reads that timed out without a report', self.usb_timeouts, **labels)
+        metrics.counter('chatmix_reports_ignored_total', 'Reports dropped for an unknown report ID or for being shorter than their layout', self.reports_ignored, **labels)
+        if self.battery is not None:
+            metrics.gauge('chatmix_battery_percent', 'Battery level last reported by the headset', self.battery, **labels)
+        if self.mic_muted is not None:
+            metrics.gauge('chatmix_mic_muted', 'Whether the headset reported its microphone as muted', int(self.mic_muted), **labels)
+        metrics.counter('chatmix_reports_dropped_total', 'Reports dropped because the applier queue was full', self.reports_dropped, **labels)
+        metrics.counter('chatmix_volume_updates_applied_total', 'Game/Chat volume pairs sent to the audio server', stats['applied'], **labels)
+        metrics.counter('chatmix_volume_updates_coalesced_total', 'Pending volume pairs replaced by a newer report', stats['coalesced'], **labels)
+        metrics.counter('chatmix_volume_updates_skipped_total', 'Reports dropped because they repeated the current pair', stats['skipped'], **labels)
+        metrics.counter('chatmix_volume_updates_failed_total', 'Volume pairs the audio server did not accept', self.volume_failures, **labels)
+        metrics.counter('chatmix_audio_reconnects_total', 'Reconnections of the native volume backend', self.volume.reconnects, **labels)
+        metrics.counter('chatmix_reopens_total', 'Times the headset was replugged and reopened with its VACs kept', self.reopens, **labels)
+        metrics.counter('chatmix_relinks_total', 'Times the VACs were linked again after the headset sink was recreated', self.relinks, **labels)
+        metrics.gauge('chatmix_sink_lost', 'Whether the headset sink is currently missing', int(self.sink_lost), **labels)
+        metrics.gauge('chatmix_ready_seconds', 'Time from process start until this headset was ready', self.ready_after, **labels)
+        metrics.gauge('chatmix_vac_init_seconds', 'Time the last VAC setup of this headset took', self.init_vac_seconds, **labels)
+        metrics.histogram('chatmix_apply_latency_seconds', 'Time from a report being read to its volumes being applied', self.apply_latency, **labels)
+        metrics.histogram('chatmix_reader_stall_seconds', 'Time the USB reader spent between reads', self.reader_stall, **labels)
+
+    def log_stats(self):
+        stats = self.coalescer.stats()
+        self.log.info(f"Dial reports: {stats['received']} received, {stats['applied']} applied, "
+                      f"{stats['coalesced']} coalesced, {stats['skipped']} skipped as duplicates, "
+                      f"{self.reports_dropped} dropped on a full queue")
+        self.log.info(f"Reader stalls: {self.reader_stall.summary()}")
+        self.log.info(f"Dial-to-volume latency: {self.apply_latency.summary()}")
+
+    def suspend(self):
+        """Stop reading the headset, e.g. because it was unplugged, keeping the VACs and the audio connection"""
+        if getattr(self, 'stopped', None):
+            if self.stopped.is_set():
+                # already suspended when it was unplugged
+                return
+            self.stopped.set()
+            self._enqueue(None)
+        if getattr(self, 'async_reader', None):
+            self.async_reader.cancel()
+        if getattr(self, 'coalescer', None):
+            self.log_stats()
+        if getattr(self, 'trace', None):
+            self.trace.flush()
+            self.log.info(f"{self.trace.records} dial reports recorded to {self.trace.path}")
+
+    def shutdown(self, sink_creation_fail=False, keep_graph=False):
+        """Stop this headset's threads and remove its VACs, leaving other headsets untouched.
+
+        With keep_graph the VACs and links stay, so a restarted daemon can pick them up without
+        interrupting the streams playing into them.
+        """
+        self.log.info(f'Cleanup of {self.headset}')
+        self.suspend()
+        if getattr(self, 'trace', None):
+            self.trace.close()
+        if getattr(self, 'volume', None):
+            self.volume.close()
+
+        # the mixer can't outlive the daemon, so it goes either way
+        if keep_graph and not getattr(self, 'mixer', None):
+            self.log.info("Keeping virtual sinks for the next start")
+            return
+        # give the default sink back once the last headset is gone
+        if self.owns_graph and self.mgr.system_default_sink and not any(service is not self for service in self.mgr.all_services()):
+            os.system(f"pactl set-default-sink {self.mgr.system_default_sink}")
+
+        if getattr(self, 'mixer', None):
+            self.log.info("Stopping ChatMix mixer...")
+            self.mixer.terminate()
+            try:
+                self.mixer.wait(timeout=2)
+            except subprocess.TimeoutExpired:
+                self.mixer.kill()
+            if self.owns_graph:
+                graph_state.remove(self.headset.location)
+        # cleanup virtual sinks if they exist
+        elif sink_creation_fail == False:
+            self.log.info("Destroying virtual sinks...")
+            self._pw_cli_batch([f'destroy {self.headset.game_sink}', f'destroy {self.headset.chat_sink}']).wait()
+            if self.owns_graph:
+                graph_state.remove(self.headset.location)
 
     def die_gracefully(self, sink_creation_fail=False, trigger=None, **kwargs):
-        """Kill the process and remove the VACs
-        on fatal exceptions or SIGTERM / SIGINT
+        """Remove the VACs of this headset on a fatal exception and report
+        the failure to the manager
         """
+        self.shutdown(sink_creation_fail=sink_creation_fail)
+        raise ChatMixError(trigger)
 
-        self.log.info('Cleanup on shutdown')
-        os.system(f"pactl set-default-sink {self.system_default_sink}")
-
-        # cleanup virtual sinks if they exist
-        if sink_creation_fail == False:
-            self.log.info("Destroying virtual sinks...")
-            os.system("pw-cli destroy Arctis_Game 1>/dev/null")
-            os.system("pw-cli destroy Arctis_Chat 1>/dev/null")
 
-        if trigger is not None:
-            self.log.info("-" * 45)
-            self.log.fatal("Failure reason: " + trigger)
-            self.log.info("-" * 45)
-            sys.exit(1)
-        else:
-            self.log.info("-" * 45)
-            self.log.info(f"{self.mgr.headset_name} ChatMix shut down gracefully... Bye Bye!")
-            self.log.info("-" * 45)
-            sys.exit(0)
+class ReplayChatMix(Arctis7PlusChatMix):
+    """Feeds the reports of a trace through the normal processing and volume path instead of reading a headset.
+    Its sinks are its own: the default sink and the running daemon's graph state are left alone.
+    """
+    require_arctis_sink = False
+    owns_graph = False
+
+    def _open_device(self):
+        pass
+
+    def _enqueue(self, item):
+        # as fast as possible means as fast as the applier keeps up, rather than dropping reports like a real headset would
+        if args.speed > 0:
+            return super()._enqueue(item)
+        self.reports.put(item)
+
+    def _read_reports(self):
+        trace = self.device
+        speed = args.speed
+        started = monotonic()
+        first = None
+        for stamp_ns, report in trace:
+            if self.stopped.is_set():
+                break
+            if speed > 0:
+                first = stamp_ns if first is None else first
+                delay = (stamp_ns - first) / 1e9 / speed - (monotonic() - started)
+                if delay > 0:
+                    sleep(delay)
+            self._on_report(report)
+        self.replay_seconds = monotonic() - started
+        self._enqueue(None)
+
+    def replay(self):
+        """Replay the whole trace, returning once every report went through the applier"""
+        self.start_modulator_signal()
+        self.reader.join()
+        self.applier.join()
+        # the last pair may still be held back by the rate limit
+        due = self.coalescer.due_in()
+        if due is not None:
+            update = self.coalescer.take(timeout=due + 0.1)
+            if update:
+                self.apply_volumes(*update)
+                self.apply_latency.observe(monotonic() - self.coalescer.taken_stamp)
+        self.log.info(f"Replayed {self.reports_read} reports in {self.replay_seconds:.3f}s "
+                      f"({self.reports_read / max(self.replay_seconds, 1e-9):.0f} reports/s)")
 
 
 class ChatMixManager:
     os = platform.freedesktop_os_release().get('ID', '')
-    device = None
     user = {'name': 'root', 'uid': 0}
-    headset_name = None
-    headset_id = None
-    service = None
+    system_default_sink = None
+
+    def __init__(self):
+        self.headsets = []
+        # running services keyed by the USB location of their headset
+        self.services = {}
+        # services of unplugged headsets, whose VACs are kept until they come back
+        self.parked = {}
+        # reentrant so the SIGTERM handler can run while the main thread holds it
+        self.lock = threading.RLock()
+        self.log = logging.getLogger(__name__)
+        self.socket = None
+        self.watcher = None
+        # set by the record command
+        self.trace_path = None
+        self.attaches = 0
+        self.vac_init = Histogram()
 
     @property
     def is_root(self):
@@ -282,55 +2362,86 @@ class ChatMixManager:
         self.user['uid'] = int(os.environ.get('SUDO_UID', os.getuid()))
         self.user['name'] = os.environ.get('SUDO_USER', getpass.getuser())
 
-    def find_headset(self, device_id=None, show=False):
-        if device_id:
-            print(f'Searching for headset with id {device_id}...')
-            dev = usb.core.find(idVendor=int(device_id.split(':')[0], 16), idProduct=int(device_id.split(':')[1], 16))
+    def find_headsets(self, device_ids=None, show=False):
+        if device_ids:
+            print(f'Searching for headsets with id {", ".join(device_ids)}...')
+            devices = []
+            for device_id in device_ids:
+                devices += usb.core.find(find_all=True, idVendor=int(device_id.split(':')[0], 16), idProduct=int(device_id.split(':')[1], 16))
         else:
-            print(f'Searching for steelseries headset...')
-            dev = usb.core.find(idVendor=VENDOR_ID, custom_match=is_arctis_headset)
+            print(f'Searching for steelseries headsets...')
+            devices = list(usb.core.find(find_all=True, idVendor=VENDOR_ID, custom_match=is_arctis_headset))
+        self.headsets = []
+        for dev in devices:
             if show:
                 print(dev)
-        if dev:
-            self.device = dev
-            self.headset_name = usb.util.get_string(dev, dev.iProduct)
-            self.headset_id = usb.util.get_string(dev, dev.iProduct).lower().replace(' ', '')
-            print(f'SteelSeries {self.headset_name} headset found.')
-
-    def install_udev_rules(self):
+            headset = Headset(dev)
+            self.headsets.append(headset)
+            print(f'SteelSeries {headset} headset found.')
+        return self.headsets
+
+    def unique_headsets(self):
+        """One headset per model; identical dongles share their udev rules and systemd unit"""
+        unique = {}
+        for headset in self.headsets:
+            unique.setdefault(headset.id, headset)
+        return list(unique.values())
+
+    def install_udev_rules(self, headset):
         udev_path = Path("/etc/udev/rules.d/")
-        rules_path = udev_path / f"{self.user['uid']}-steeleries-{self.headset_id}.rules"
-        print(f'Installing udev rules for {usb.util.get_string(self.device, self.device.iProduct)} to {rules_path}')
-        if self.os == 'manjaro' or self.os == 'arch' or self.os == 'archarm' or self.os == 'manjarolinux':
+        rules_path = udev_path / f"{self.user['uid']}-steeleries-{headset.id}.rules"
+        print(f'Installing udev rules for {headset.name} to {rules_path}')
+        # only one OWNER can win, so when several users get the headset the active session's user gets access instead
+        shared = args.all_users or any(not path.name.startswith(f"{self.user['uid']}-") for path in udev_path.glob(f'*-steeleries-{headset.id}.rules'))
+        if shared or self.os == 'manjaro' or self.os == 'arch' or self.os == 'archarm' or self.os == 'manjarolinux':
             contents = (
-                f'SUBSYSTEM=="usb", ATTRS{{idVendor}}=="{VENDOR_ID:04x}", ATTRS{{idProduct}}=="{self.device.idProduct:04x}", TAG+="uaccess", MODE="0660"\n'
-                f'ACTION=="add", SUBSYSTEM=="usb", ATTRS{{idVendor}}=="{VENDOR_ID:04x}", ATTRS{{idProduct}}=="{self.device.idProduct:04x}", ENV{{SYSTEMD_USER_WANTS}}+="chatmix-{self.headset_id}.service"\n'
-                f'ACTION=="remove", SUBSYSTEM=="usb", ENV{{PRODUCT}}=="{VENDOR_ID:04x}/{self.device.idProduct:04x}/*", TAG+="systemd"\n'
+                f'SUBSYSTEM=="usb", ATTRS{{idVendor}}=="{VENDOR_ID:04x}", ATTRS{{idProduct}}=="{headset.product_id:04x}", TAG+="uaccess", MODE="0660"\n'
+                f'ACTION=="add", SUBSYSTEM=="usb", ATTRS{{idVendor}}=="{VENDOR_ID:04x}", ATTRS{{idProduct}}=="{headset.product_id:04x}", ENV{{SYSTEMD_USER_WANTS}}+="{SERVICE_NAME}"\n'
+                f'ACTION=="remove", SUBSYSTEM=="usb", ENV{{PRODUCT}}=="{VENDOR_ID:04x}/{headset.product_id:04x}/*", TAG+="systemd"\n'
             )
         else:
             contents = (
-                f'SUBSYSTEM=="usb", ATTRS{{idVendor}}=="{VENDOR_ID:04x}", ATTRS{{idProduct}}=="{self.device.idProduct:04x}", OWNER="{self.user["name"]}", GROUP="{self.user["name"]}", MODE="0664"\n'
-                f'ACTION=="add", SUBSYSTEM=="usb", ATTRS{{idVendor}}=="{VENDOR_ID:04x}", ATTRS{{idProduct}}=="{self.device.idProduct:04x}", TAG+="systemd", ENV{{SYSTEMD_ALIAS}}="/dev/arctis7"\n'
-                f'ACTION=="remove", SUBSYSTEM=="usb", ENV{{PRODUCT}}=="{VENDOR_ID:04x}/{self.device.idProduct:04x}/*", TAG+="systemd"\n'
+                f'SUBSYSTEM=="usb", ATTRS{{idVendor}}=="{VENDOR_ID:04x}", ATTRS{{idProduct}}=="{headset.product_id:04x}", OWNER="{self.user["name"]}", GROUP="{self.user["name"]}", MODE="0664"\n'
+                f'ACTION=="add", SUBSYSTEM=="usb", ATTRS{{idVendor}}=="{VENDOR_ID:04x}", ATTRS{{idProduct}}=="{headset.product_id:04x}", TAG+="systemd", ENV{{SYSTEMD_ALIAS}}="/dev/arctis7"\n'
+                f'ACTION=="remove", SUBSYSTEM=="usb", ENV{{PRODUCT}}=="{VENDOR_ID:04x}/{headset.product_id:04x}/*", TAG+="systemd"\n'
             )
         with open(rules_path, "w") as f:
             f.write(contents)
-        subprocess.run(['sudo', 'udevadm', 'control', '--reload'], check=True)
-        subprocess.run(['sudo', 'udevadm', 'trigger'], check=True)
-        print(f'udev rules installed for {self.user['name']}-{self.headset_id} . A reboot will be required for changes to take effect.')
+        print(f'udev rules installed for {self.user['name']}-{headset.id}.')
 
-    def uninstall_udev_rules(self):
+    def uninstall_udev_rules(self, headset):
         udev_path = Path("/etc/udev/rules.d/")
-        rules_path = udev_path / f"{self.user['uid']}-steeleries-{self.headset_id}.rules"
+        rules_path = udev_path / f"{self.user['uid']}-steeleries-{headset.id}.rules"
         if rules_path.exists():
             rules_path.unlink()
-            subprocess.run(['sudo', 'udevadm', 'control', '--reload'])
-            subprocess.run(['sudo', 'udevadm', 'trigger'])
-            print(f'udev rules for {self.user['name']}-{self.headset_id} removed. A reboot will be required for changes to take effect.')
+            print(f'udev rules for {self.user['name']}-{headset.id} removed.')
 
-    def install_systemd_unit(self):
+    @staticmethod
+    def reload_udev(product_ids=None):
+        """Reload the udev rules once and re-trigger only the matching SteelSeries USB devices,
+        all of them if no product ids are given.  Returns the time (reload, trigger) took.
+        """
+        started = monotonic()
+        subprocess.run(['sudo', 'udevadm', 'control', '--reload'], check=True)
+        reloaded = monotonic()
+        # property matches are alternatives, attribute matches all have to match
+        trigger = ['sudo', 'udevadm', 'trigger', '--subsystem-match=usb', f'--attr-match=idVendor={VENDOR_ID:04x}']
+        trigger += [f'--property-match=PRODUCT={VENDOR_ID:x}/{product_id:x}/*' for product_id in sorted(product_ids or ())]
+        subprocess.run(trigger, check=True)
+        return reloaded - started, monotonic() - reloaded
+
+    def install_systemd_unit(self, headsets):
+        """Install the unit running the daemon for all headsets of the user"""
+        systemd_unit = self.systemd_unit()
+        # one daemon per user: without --device it drives every known model; models it doesn't know have to be listed,
+        # and then the known ones too
+        devices = ''
+        if any(headset.product_id not in STEELSERIES_DEVICES for headset in headsets):
+            device_ids = [f'{VENDOR_ID:04x}:{product_id:04x}' for product_id in STEELSERIES_DEVICES]
+            device_ids += [headset.device_id for headset in headsets if headset.device_id not in device_ids]
+            devices = ''.join(f' --device {device_id}' for device_id in device_ids)
         contents = f'[Unit]\n' \
-                f'Description={self.headset_name} ChatMix\n' \
+                f'Description=SteelSeries ChatMix\n' \
                 f'#BindsTo=dev-arctis7.device\n' \
                 f'After=dev-arctis7.device\n' \
                 f'StartLimitIntervalSec=1m\n' \
@@ -338,115 +2449,441 @@ class ChatMixManager:
                 '\n' \
                 f'[Service]\n' \
                 f'Type=simple\n' \
-                f'ExecStart={Path(__file__).resolve()} daemon --device {self.device.idVendor:04x}:{self.device.idProduct:04x}\n' \
+                f'ExecStart={Path(__file__).resolve()} daemon{devices}\n' \
                 f'Restart=on-failure\n' \
                 f'RestartSec=5\n'
-        if not self.systemd_unit.parent.exists():
-            self.systemd_unit.parent.mkdir(parents=True, exist_ok=True)
-        if not self.systemd_unit.exists() or args.force:
-            print(f'Installing systemd unit for {usb.util.get_string(self.device, self.device.iProduct)} to {self.systemd_unit}')
-            with open(self.systemd_unit, 'w') as f:
+        self._make_user_dirs(systemd_unit.parent)
+        # units of older versions ran one daemon per headset model
+        self._remove_units('chatmix-*.service')
+        if not systemd_unit.exists() or args.force:
+            print(f'Installing systemd unit to {systemd_unit}')
+            with open(systemd_unit, 'w') as f:
                 f.write(contents)
-            os.chmod(self.systemd_unit, 0o644)
-            os.chown(self.systemd_unit, self.user['uid'], self.user['uid'])
-            subprocess.run(['sudo', 'systemctl', '--user', f'--machine={self.user['name']}@.host', 'enable', self.systemd_unit.name], check=True)
+            os.chmod(systemd_unit, 0o644)
+            os.chown(systemd_unit, self.user['uid'], pwd.getpwuid(self.user['uid']).pw_gid)
+            # fails for users without a running systemd user instance, the udev rule starts the unit anyway
+            if subprocess.run(['sudo', 'systemctl', '--user', f'--machine={self.user['name']}@.host', 'enable', systemd_unit.name]).returncode != 0:
+                print(f'Could not enable {systemd_unit.name} for {self.user['name']}, it will still be started when the headset is plugged in.')
         else:
-            print(f'{self.systemd_unit.name} already exists in systemd user directory.  Skipping installation. (Use -f to overwrite.)')
+            print(f'{systemd_unit.name} already exists in systemd user directory.  Skipping installation. (Use -f to overwrite.)')
+
+    def _make_user_dirs(self, path):
+        """Create path and any missing parents owned by the current user, not by root running the install"""
+        missing = []
+        while not path.exists():
+            missing.append(path)
+            path = path.parent
+        for path in reversed(missing):
+            path.mkdir()
+            os.chown(path, self.user['uid'], pwd.getpwuid(self.user['uid']).pw_gid)
+
+    def purge(self, udev=True, systemd=True):
+        """Remove every ChatMix udev rule and/or systemd unit of the current user, whichever headsets they were for.
+        Returns the product ids the removed rules were for.
+        """
+        product_ids = set()
+        if udev:
+            for rules_path in self.installed_rules():
+                product_ids.update(int(product, 16) for product in re.findall(r'idProduct}=="([0-9a-f]{4})"', rules_path.read_text()))
+                rules_path.unlink()
+                print(f'Removed {rules_path}')
+        if systemd:
+            self._remove_units('chatmix*.service')
+        return product_ids
+
+    def _remove_units(self, pattern):
+        """Stop, disable and delete the user's units matching pattern"""
+        systemd_dir = self.systemd_unit().parent
+        for unit in sorted(systemd_dir.glob(pattern)):
+            subprocess.run(['sudo', 'systemctl', '--user', f'--machine={self.user['name']}@.host', 'disable', '--now', unit.name],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            unit.unlink()
+            print(f'Removed {unit}')
+        # enable links left behind when the user's systemd instance wasn't running
+        for link in systemd_dir.glob(f'*.wants/{pattern}'):
+            link.unlink()
+
+    def target_users(self):
+        """Users to provision: every desktop user with --all-users, otherwise the sudo user"""
+        if not args.all_users:
+            return [dict(self.user)]
+        return [{'name': user.pw_name, 'uid': user.pw_uid, 'home': user.pw_dir} for user in pwd.getpwall()
+                if 1000 <= user.pw_uid < 65534 and Path(user.pw_dir).is_dir()]
+
+    def provisioning_headsets(self):
+        """Connected headsets, one per model.  When none is plugged in, the models given with --device, or every
+        known model with --all-users, so machines can be provisioned before a headset is ever connected.
+        """
+        if self.find_headsets(args.device):
+            return self.unique_headsets()
+        if not args.device and not args.all_users:
+            return []
+        product_ids = [int(device_id.split(':')[1], 16) for device_id in args.device or ()] or list(STEELSERIES_DEVICES)
+        headsets = [ModelHeadset(product_id) for product_id in product_ids if product_id in STEELSERIES_DEVICES]
+        if headsets:
+            print(f'No headset plugged in, using the {", ".join(str(headset) for headset in headsets)} models')
+        return headsets
+
+    def installed_rules(self):
+        return sorted(Path('/etc/udev/rules.d/').glob(f"{self.user['uid']}-steeleries-*.rules"))
 
     def uninstall_systemd_unit(self):
-        systemd_dir = Path('/home') / self.user['name'] / '.config' / 'systemd' / 'user'
-        filename = f'chatmix-{self.headset_id}.service'
-        file_path = systemd_dir / filename
-        subprocess.run(['sudo', 'systemctl', '--user', f'--machine={self.user['name']}@.host', 'disable', filename])
+        file_path = self.systemd_unit()
+        subprocess.run(['sudo', 'systemctl', '--user', f'--machine={self.user['name']}@.host', 'disable', file_path.name])
         if file_path.exists():
             file_path.unlink()
-            print(f'{filename} already exists in systemd user directory.  Skipping installation. (Use -f to overwrite.)')
+            print(f'{file_path.name} removed from systemd user directory.')
+
+    def all_services(self):
+        """Running and parked services, i.e. every headset whose VACs exist"""
+        with self.lock:
+            return list(self.services.values()) + list(self.parked.values())
+
+    def attach(self, headset):
+        """Start the ChatMix service of a newly found headset.  Returns False if it couldn't be started."""
+        with self.lock:
+            parked = self.parked.pop(headset.location, None)
+            moved = None if parked else self._pop_moved(headset)
+        if moved:
+            # its VACs are named after the old port, start over rather than leave them behind
+            self.log.info(f"{headset} was plugged in at {moved.headset.location} before, removing the VACs kept for it")
+            moved.shutdown()
+        if parked and parked.headset.device_id == headset.device_id:
+            try:
+                with self.lock:
+                    self.services[headset.location] = parked
+                parked.reopen(headset)
+                self.attaches += 1
+                return True
+            except (ChatMixError, usb.core.USBError) as e:
+                self.log.error(f"Reopening {headset} failed ({e}), setting it up again")
+                with self.lock:
+                    self.services.pop(headset.location, None)
+        if parked:
+            parked.shutdown()
+        try:
+            service = Arctis7PlusChatMix(self, headset)
+        except ChatMixError as e:
+            self.log.info("-" * 45)
+            self.log.fatal(f"{headset} failed, reason: {e}")
+            self.log.info("-" * 45)
+            return False
+        with self.lock:
+            self.services[headset.location] = service
+            self.attaches += 1
+        service.start_modulator_signal()
+        return True
+
+    def _pop_moved(self, headset):
+        """The parked service of this dongle if it was replugged into another port: the one with its serial,
+        or the only parked one of its model.  Called with the lock held.
+        """
+        same_model = [service for service in self.parked.values() if service.headset.device_id == headset.device_id]
+        matches = [service for service in same_model if headset.serial and service.headset.serial == headset.serial]
+        # without serials to compare, only a single parked headset of the model can be told apart
+        if not matches and len(same_model) == 1 and not (headset.serial and same_model[0].headset.serial):
+            matches = same_model
+        if len(matches) != 1:
+            return None
+        return self.parked.pop(matches[0].headset.location)
+
+    def detach(self, service):
+        """Stop reading a headset that was unplugged; called from that headset's reader thread.
+
+        Its VACs and links stay, so streams keep their routing and the headset is only reopened when it returns.
+        """
+        with self.lock:
+            if self.services.get(service.headset.location) is not service:
+                return
+            del self.services[service.headset.location]
+            self.parked[service.headset.location] = service
+        service.suspend()
+        self.log.info(f"Keeping the VACs of {service.headset} until it is plugged in again")
+
+    def run_daemon(self, device_ids=None, monitor=None):
+        """Attach every matching headset, then wait for more to be plugged in"""
+        # set to receive signal from systemd for termination
+        signal.signal(signal.SIGTERM, self.__handle_sigterm)
+        try:
+            self.reload_config()
+        except ChatMixError as e:
+            self.log.warning(f"{e}, using the command line settings")
+        try:
+            self.socket = DaemonSocket(daemon_socket_path(self.user['uid']), {
+                '/metrics': self.render_metrics,
+                '/status': self.render_status,
+                '/headsets': self.render_headsets,
+                '/levels': self.render_levels,
+            }, actions={
+                '/relink': self.relink_all,
+                '/reload': self.reload_config,
+            })
+        except ChatMixError as e:
+            # a second daemon would fight over the headsets and the graph state
+            self.log.fatal(str(e))
+            sys.exit(1)
+        except OSError as e:
+            self.log.warning(f"Metrics socket unavailable: {e}")
+        try:
+            self.watcher = SinkWatcher(self)
+        except PulseError as e:
+            self.log.warning(f"Audio server events unavailable ({e}), headsets won't be relinked if their sink is recreated")
+        # location -> (failed attempts, monotonic time of the next attempt) of headsets that couldn't be started yet
+        retries = {}
+        # locations of headsets that failed every retry, left alone until they are unplugged
+        given_up = set()
+        while True:
+            now = monotonic()
+            headsets = self.find_headsets(device_ids)
+            # forget headsets that were unplugged while waiting for their retry or after being given up on
+            present = {headset.location for headset in headsets}
+            retries = {location: retry for location, retry in retries.items() if location in present}
+            given_up &= present
+            for headset in headsets:
+                if headset.location in self.services or headset.location in given_up:
+                    continue
+                attempts, due = retries.get(headset.location, (0, now))
+                if due > now:
+                    continue
+                if self.attach(headset):
+                    retries.pop(headset.location, None)
+                    continue
+                # the usb add event comes before the audio server has created the headset's sink, give it time
+                if attempts < len(ATTACH_RETRY_DELAYS):
+                    delay = ATTACH_RETRY_DELAYS[attempts]
+                    self.log.warning(f"Retrying {headset} in {delay:g}s")
+                    retries[headset.location] = (attempts + 1, now + delay)
+                    continue
+                retries.pop(headset.location)
+                given_up.add(headset.location)
+                # with nothing else running, exit so systemd restarts us like a single headset daemon
+                if not self.services:
+                    self.die_gracefully(trigger=f"{headset} could not be started")
+                self.log.error(f"Giving up on {headset} until it is plugged in again")
+            timeout = max(0.0, min(due for _, due in retries.values()) - monotonic()) if retries else None
+            if monitor:
+                event = monitor.wait_for_headset(timeout)
+                if event:
+                    print(f'Headset {event.get("PRODUCT")} plugged in at {event.get("DEVPATH")}.')
+            else:
+                sleep(3 if timeout is None else min(3, timeout))
+
+    def render_metrics(self):
+        metrics = Metrics()
+        with self.lock:
+            services = list(self.services.values())
+        metrics.gauge('chatmix_headsets', 'Headsets currently driven by the daemon', len(services))
+        metrics.gauge('chatmix_headsets_parked', 'Unplugged headsets whose VACs are kept', len(self.parked))
+        metrics.counter('chatmix_headset_attaches_total', 'Headsets attached since the daemon started, including reconnects', self.attaches)
+        metrics.histogram('chatmix_vac_init_duration_seconds', 'Time spent in _init_VAC per attach', self.vac_init)
+        if self.watcher:
+            metrics.counter('chatmix_audio_event_reconnects_total', 'Reconnections of the audio server event subscription', self.watcher.reconnects)
+            metrics.counter('chatmix_streams_routed_total', 'Streams moved to a Game or Chat sink by the routing rules', self.watcher.routed)
+        for service in services:
+            service.collect_metrics(metrics)
+        return metrics.render()
+
+    def reload_config(self):
+        """Apply the config file to the running daemon"""
+        config = load_config()
+        # replaces the whole config, settings no longer in the file go back to their command line values
+        settings.config = config
+        for service in self.all_services():
+            service.coalescer.set_max_rate(settings.max_rate)
+        summary = ', '.join(f'{len(value)} routes' if key == 'routes' else f'{key}={value}' for key, value in config.items()) or 'no settings'
+        self.log.info(f"Loaded {config_path()}: {summary}")
+        return f'Reloaded {config_path()}: {summary}\n'
+
+    def relink_all(self):
+        """Link every headset to its sink again now, e.g. after the links were removed in a patchbay"""
+        lines = []
+        for service in self.all_services():
+            relinks = service.relinks
+            service.relink(service.sink)
+            lines.append(f'{service.headset}: {"relinked to " + service.sink if service.relinks > relinks else "relink failed"}')
+        return ''.join(f'{line}\n' for line in lines) or 'No headsets.\n'
+
+    def _service_line(self, service, parked):
+        line = f'{service.headset}: {"unplugged, VACs kept" if parked else "active"}, sink {service.sink}'
+        if service.sink_lost:
+            line += ' (missing)'
+        if service.battery is not None:
+            line += f', battery {service.battery}%'
+        if service.mic_muted is not None:
+            line += f', microphone {"muted" if service.mic_muted else "on"}'
+        return line
+
+    def render_status(self):
+        with self.lock:
+            services = [(service, False) for service in self.services.values()] + [(service, True) for service in self.parked.values()]
+        lines = [f'ChatMix daemon running as pid {os.getpid()} for {process_uptime():.0f}s, {args.graph} graph, max {settings.max_rate:g} updates/s']
+        for service, parked in services:
+            lines.append('  ' + self._service_line(service, parked))
+            levels = service.coalescer.levels()
+            if levels:
+                lines.append(f'    Game {levels[0]}%, Chat {levels[1]}%')
+        if not services:
+            lines.append('  No headsets connected.')
+        return ''.join(f'{line}\n' for line in lines)
+
+    def render_headsets(self):
+        with self.lock:
+            services = [(service, False) for service in self.services.values()] + [(service, True) for service in self.parked.values()]
+        return ''.join(f'{self._service_line(service, parked)}\n' for service, parked in services) or 'No headsets connected.\n'
+
+    def render_levels(self):
+        lines = []
+        for service in self.all_services():
+            levels = service.coalescer.levels()
+            lines.append(f'{service.headset.location} game={levels[0] if levels else "-"} chat={levels[1] if levels else "-"}')
+        return ''.join(f'{line}\n' for line in lines)
+
+    def print_daemon(self, route, method='GET'):
+        """Print the answer of the running daemon to a control request"""
+        self.find_desktop_user()
+        try:
+            reply = daemon_request(self.user['uid'], route, method)
+        except ChatMixError as e:
+            print(f'ChatMix daemon: {e}')
+            sys.exit(1)
+        if reply is None:
+            print('ChatMix daemon is not running.')
+            sys.exit(1)
+        print(reply, end='')
+
+    def print_stats(self):
+        self.print_daemon('/metrics')
+
+    def __handle_sigterm(self, sig, frame):
+        self.die_gracefully()
+
+    def die_gracefully(self, trigger=None):
+        """Kill the process and remove the VACs of every headset
+        on fatal exceptions or SIGTERM / SIGINT.
 
-    def run_chatmix(self):
-        a7pcm_service = Arctis7PlusChatMix(self)
-        self.service = a7pcm_service
-        a7pcm_service.start_modulator_signal()
+        After a failure under systemd the VACs are kept for the restarted daemon to reuse, as they are on any stop
+        with --keep-graph.  Otherwise nothing may restart it, so the default sink is given back.
+        """
+        self.log.info('Cleanup on shutdown')
+        if self.socket:
+            self.socket.close()
+        if self.watcher:
+            self.watcher.close()
+        # systemd sets INVOCATION_ID for the processes of a unit
+        keep_graph = args.keep_graph or (trigger is not None and 'INVOCATION_ID' in os.environ)
+        while True:
+            with self.lock:
+                if not self.services and not self.parked:
+                    break
+                _, service = (self.services or self.parked).popitem()
+            service.shutdown(keep_graph=keep_graph)
+
+        if trigger is not None:
+            self.log.info("-" * 45)
+            self.log.fatal("Failure reason: " + trigger)
+            self.log.info("-" * 45)
+            sys.exit(1)
+        else:
+            self.log.info("-" * 45)
+            self.log.info(f"ChatMix shut down gracefully... Bye Bye!")
+            self.log.info("-" * 45)
+            sys.exit(0)
 
     def print_status(self):
         self.find_desktop_user()
-        self.find_headset(args.device)
-        if self.device is None:
+        # the running daemon knows, without enumerating USB devices or asking systemd
+        try:
+            reply = daemon_request(self.user['uid'], '/status')
+        except ChatMixError:
+            reply = None
+        if reply is not None:
+            print(reply, end='')
+            return
+        self.find_headsets(args.device)
+        if not self.headsets:
             print("No headsets found.")
 
-        if self.systemd_unit.exists():
-            subprocess.run(['systemctl', '--user', f'--machine={self.user['name']}@.host', 'status', self.systemd_unit.name], check=True)
+        if self.systemd_unit().exists():
+            subprocess.run(['systemctl', '--user', f'--machine={self.user['name']}@.host', 'status', SERVICE_NAME])
 
     def print_headsets(self):
         self.find_desktop_user()
-        self.find_headset(args.device, show=True)
-        if self.device is None:
+        try:
+            reply = daemon_request(self.user['uid'], '/headsets')
+        except ChatMixError:
+            reply = None
+        if reply is not None:
+            print(reply, end='')
+            return
+        self.find_headsets(args.device, show=True)
+        if not self.headsets:
             print("No headsets found.")
 
-    @property
     def systemd_unit(self):
-        systemd_dir = Path('/home') / self.user['name'] / '.config' / 'systemd' / 'user'
-        filename = f'chatmix-{self.headset_id}.service'
-        return systemd_dir / filename
+        home = Path(self.user.get('home') or Path('/home') / self.user['name'])
+        systemd_dir = home / '.config' / 'systemd' / 'user'
+        return systemd_dir / SERVICE_NAME
 
 
 
 def run_main():
     mgr = ChatMixManager()
 
-    if args.command == 'install':
-        mgr.find_desktop_user()
-        if os.getuid() != 0:
-            print('Error: This must be ran as a desktop user with sudo.')
-            sys.exit(1)
-        if mgr.is_root:
-            print('You cannot install a headset as root. Run as a logged in desktop user with sudo.')
-            sys.exit(1)
-        mgr.find_headset(args.device)
-        if args.subcommand == 'udev' or args.subcommand is None:
-            mgr.install_udev_rules()
-        if args.subcommand == 'systemd' or args.subcommand is None:
-            mgr.install_systemd_unit()
-
-    elif args.command == 'uninstall':
+    if args.command in ('install', 'uninstall', 'purge'):
         mgr.find_desktop_user()
         if os.getuid() != 0:
             print('Error: This must be ran as a desktop user with sudo.')
             sys.exit(1)
-        if mgr.is_root:
-            print('You cannot uninstall a headset as root. Run as a logged in desktop user with sudo.')
-            sys.exit(1)
-        mgr.find_headset(args.device)
-        # Stop the service if running
-        subprocess.run(['systemctl', '--user', f'--machine={mgr.user['name']}@.host', args.command, f'chatmix-{mgr.headset_id}.service'], check=True)
-
-        if args.subcommand == 'udev' or args.subcommand is None:
-            mgr.uninstall_udev_rules()
-        if args.subcommand == 'systemd' or args.subcommand is None:
-            mgr.uninstall_systemd_unit()
-
-    elif args.command == 'purge':
-        mgr.find_desktop_user()
-        if os.getuid() != 0:
-            print('Error: This must be ran as a desktop user with sudo.')
+        if mgr.is_root and not args.all_users:
+            print(f'You cannot {args.command} a headset as root. Run as a logged in desktop user with sudo, or use --all-users.')
             sys.exit(1)
-        if mgr.is_root:
-            print('Error: run as a logged in desktop user with sudo.')
+        started = monotonic()
+        headsets = [] if args.command == 'purge' else mgr.provisioning_headsets()
+        if args.command != 'purge' and not headsets:
+            print('No headset found.' if args.command == 'install' else 'No headset found, give its id with -d or use chatmix purge.')
             sys.exit(1)
-        # TODO: purge all systemd units and udev rules for the user. Maybe have --all-users, -a to do everyone
+        udev = args.subcommand == 'udev' or args.subcommand is None
+        systemd = args.subcommand == 'systemd' or args.subcommand is None
+        product_ids = {headset.product_id for headset in headsets}
+        users = mgr.target_users()
+        for user in users:
+            mgr.user = user
+            if args.command == 'purge':
+                product_ids |= mgr.purge(udev, systemd)
+                continue
+            if args.command == 'install':
+                for headset in headsets:
+                    if udev:
+                        mgr.install_udev_rules(headset)
+                if systemd:
+                    mgr.install_systemd_unit(headsets)
+                continue
+            for headset in headsets:
+                if udev:
+                    mgr.uninstall_udev_rules(headset)
+            # the unit is shared by all headsets, keep it while rules for another model are left
+            if systemd and (args.subcommand == 'systemd' or not mgr.installed_rules()):
+                # Stop the service if running
+                subprocess.run(['systemctl', '--user', f'--machine={mgr.user['name']}@.host', 'stop', SERVICE_NAME])
+                mgr.uninstall_systemd_unit()
+        written = monotonic()
+        # one reload and one trigger of the affected devices for the whole batch instead of a full trigger per rules file
+        reload_time = trigger_time = 0
+        if udev and product_ids:
+            reload_time, trigger_time = mgr.reload_udev(product_ids)
+        print(f'{args.command.capitalize()} done for {len(users)} user(s): files {(written - started) * 1000:.0f} ms, '
+              f'udev reload {reload_time * 1000:.0f} ms, trigger {trigger_time * 1000:.0f} ms, total {(monotonic() - started) * 1000:.0f} ms')
 
     elif args.command in ('start', 'stop', 'restart', 'enable', 'disable'):
         mgr.find_desktop_user()
         if mgr.is_root:
             print('Error: This must be ran as a logged in desktop user.')
             sys.exit(1)
-        mgr.find_headset(args.device)
-        if mgr.device:
-            service_name = f'chatmix-{mgr.headset_id}.service'
-            subprocess.run(['systemctl', '--user', f'--machine={mgr.user['name']}@.host', args.command, service_name], check=True)
-            print(f'{args.command.capitalize()}ed {service_name}')
-        else:
-            print('No headset found.')
+        if not mgr.systemd_unit().exists():
+            print(f'{SERVICE_NAME} is not installed, run sudo chatmix install first.')
             sys.exit(1)
+        subprocess.run(['systemctl', '--user', f'--machine={mgr.user['name']}@.host', args.command, SERVICE_NAME], check=True)
+        print(f'{args.command.capitalize()}ed {SERVICE_NAME}')
 
     elif args.command == 'status':
         mgr.print_status()
@@ -454,27 +2891,62 @@ def run_main():
     elif args.command == 'headsets':
         mgr.print_headsets()
 
-    elif args.command == 'daemon':
+    elif args.command == 'stats':
+        mgr.print_stats()
+
+    elif args.command == 'levels':
+        mgr.print_daemon('/levels')
+
+    elif args.command in ('relink', 'reload'):
+        mgr.print_daemon(f'/{args.command}', 'POST')
+
+    elif args.command in ('daemon', 'record'):
         mgr.find_desktop_user()
         print(f'Running daemon as {mgr.user["name"]} ({mgr.user["uid"]}).')
-        while True:
+        if args.command == 'record':
+            mgr.trace_path = args.trace or 'chatmix-{location}.trace'
+        setup_logging()
+        monitor = None
+        if args.hotplug == 'netlink':
             try:
-                if not mgr.device:
-                    mgr.find_headset(args.device)
-                    if mgr.device:
-                        print(f'SteelSeries {mgr.headset_name} headset found.')
-                        mgr.run_chatmix()
-                sleep(3)
-            except KeyboardInterrupt:
-                exit(0)
-            except Exception as e:
-                print(e)
-                if mgr.service:
-                    try:
-                        mgr.service.die_gracefully()
-                    except:
-                        pass
-                exit(1)
+                # listen before the first scan so a headset plugged in meanwhile isn't missed
+                monitor = HotplugMonitor(args.device)
+            except OSError as e:
+                print(f'udev netlink monitor unavailable ({e}), polling for headsets instead.')
+        try:
+            mgr.run_daemon(args.device, monitor)
+        except KeyboardInterrupt:
+            mgr.die_gracefully()
+        except Exception as e:
+            print(e)
+            mgr.die_gracefully(trigger=str(e))
+
+    elif args.command == 'replay':
+        if not args.trace:
+            print('replay needs a --trace file.')
+            sys.exit(1)
+        mgr.find_desktop_user()
+        setup_logging()
+        try:
+            trace = TraceReader(args.trace)
+        except (OSError, ChatMixError) as e:
+            print(f'Cannot replay {args.trace}: {e}')
+            sys.exit(1)
+        if not len(trace):
+            print(f'{args.trace} has no recorded reports.')
+            sys.exit(1)
+        print(f'Replaying {len(trace)} reports of {trace.name} from {args.trace}.')
+        try:
+            service = ReplayChatMix(mgr, TraceHeadset(trace))
+            with mgr.lock:
+                mgr.services[service.headset.location] = service
+            service.replay()
+        except KeyboardInterrupt:
+            mgr.die_gracefully()
+        except Exception as e:
+            print(e)
+            mgr.die_gracefully(trigger=str(e))
+        mgr.die_gracefully()
 
     elif args.command == 'help':
             parser.print_help()
@@ -485,4 +2957,5 @@ def run_main():
         sys.exit(1)
 
 if __name__ == '__main__':
+    args = parser.parse_args()
     run_main()
\ No newline at end of file